@@ -1,8 +1,23 @@
+import json
+
 import pandas as pd
 import altair as alt
 import numpy as np
 
 
+def time_step_ids(ts, mjds):
+    '''
+    Index of each mjd in the sorted unique time steps ts. Raises KeyError for mjds that are not one of the time steps.
+    '''
+    mjds = np.asarray(mjds)
+    ids = np.searchsorted(ts, mjds)
+    found = ids < len(ts)
+    found[found] = ts[ids[found]] == mjds[found]
+    if not found.all():
+        raise KeyError('mjdExpStart %s is not a field time step' % mjds[~found][0])
+    return ids
+
+
 def get_data(data, moon_data=True):
     '''
     Takes the sdss field data, rounds floats, subsets to only observed fields, and calculates utcs times.
@@ -16,21 +31,18 @@ def get_data(data, moon_data=True):
     renamed_star_cols = ['alt', 'az', 'tsid', 'mag']
     renamed_moon_cols = ['mAlt', 'mAz', 'tsid', 'phase']
 
-    # round columms
-    for col in data.dtypes[data.dtypes == 'float64'].index:
-        data[col] = round(data[col], 6)
-        data['moonSep'] = round(data['moonSep'], 1)
+    # round columms, in one pass, single precision columns are widened first
+    # so that they round the same as the double precision ones
+    float_cols = data.select_dtypes(['float64', 'float32']).columns
+    data[float_cols] = data[float_cols].astype('float64').round(6)
+    data['moonSep'] = data['moonSep'].round(1)
 
     scheduled = data.loc[data['scheduled']==True]
-    scheduled.sort_values('mjdExpStart', inplace=True)
 
     ####################
     #    Extract relevant field data into dataset
     ####################
     fields = data.query('objType == "sdss field"')
-    timestamps = pd.to_datetime(fields['mjdExpStart'] + 2400000.5, unit='D', origin='julian') - pd.Timedelta(hours=6)
-    datetimes = [dt.to_pydatetime().strftime("%Y-%m-%dT%H:%M:%S") for dt in timestamps]
-    fields['Observation Start Time'] = datetimes
     fields = fields.loc[fields['alt'] > -.5] # could change to use 'Risen'
 
     ####################
@@ -41,24 +53,29 @@ def get_data(data, moon_data=True):
 
     # Round mangitudes to nearest 0.5
     stars = stars.query('magnitude < 4.5')
-    stars['mag'] = round(stars['magnitude'], 0)
+    stars['mag'] = stars['magnitude'].round(0)
 
     ####################
     # Create different field statuses
     ####################
-    fields['fieldStatus'] = 'Available'
-    fields.loc[fields['scheduled'], 'fieldStatus'] = 'Scheduled Now'
-    fields.loc[fields['alt'] < 40, 'fieldStatus'] = 'Unavailable'
-
-    fields['Scheduled'] = False
-    fields.loc[fields['fieldID'].isin(scheduled['fieldID']), 'Scheduled'] = True
+    fields['fieldStatus'] = np.select(
+        [fields['alt'] < 40, fields['scheduled']],
+        ['Unavailable', 'Scheduled Now'],
+        default='Available'
+    )
+    fields['Scheduled'] = fields['fieldID'].isin(scheduled['fieldID'])
 
     ####################
     # Assign observation numbers as time step id
     ####################
-    ts = {mjd: ii for ii, mjd in enumerate(fields['mjdExpStart'].sort_values().unique())}
-    fields['time_step_id'] = [ts[mjd] for mjd in fields['mjdExpStart']]
-    stars['time_step_id'] = [ts[mjd] for mjd in stars['mjdExpStart']]
+    ts = np.sort(fields['mjdExpStart'].unique())
+    fields['time_step_id'] = time_step_ids(ts, fields['mjdExpStart'])
+    stars['time_step_id'] = time_step_ids(ts, stars['mjdExpStart'])
+
+    # format each time step once and look the strings up by time step id
+    timestamps = pd.to_datetime(ts + 2400000.5, unit='D', origin='julian') - pd.Timedelta(hours=6)
+    ts_str = np.asarray(timestamps.strftime("%Y-%m-%dT%H:%M:%S"), dtype=object)
+    fields['Observation Start Time'] = ts_str[fields['time_step_id'].to_numpy()]
 
     ###################
     # Rename columns
@@ -66,18 +83,13 @@ def get_data(data, moon_data=True):
     fields.rename(columns={old:new for old, new in zip(field_cols, renamed_field_cols)}, inplace=True)
     stars.rename(columns={old:new for old, new in zip(star_cols, renamed_star_cols)}, inplace=True)
 
-    # round columms
-    for col in data.dtypes[data.dtypes == 'float64'].index:
-        data[col] = round(data[col], )
-        data['moonSep'] = round(data['moonSep'], 1)
-
     ####################
     #    Extract relevant moon data into dataset
     ####################
     if moon_data:
         moon = fields[['mjdExpStart', 'moonAz', 'moonAlt', 'moonPhase']].drop_duplicates()
         moon = moon.loc[moon['moonAlt'] > -.5]
-        moon['time_step_id'] = [ts[mjd] for mjd in moon['mjdExpStart']]
+        moon['time_step_id'] = time_step_ids(ts, moon['mjdExpStart'])
 
         # Get moon phase emoji
         avg_moon_phase = np.nanmean(moon['moonPhase'])
@@ -86,20 +98,169 @@ def get_data(data, moon_data=True):
                       '🌓': [.3,.7],
                       '🌔': [.7,.9],
                       '🌕': [.9,1.01]}
-        phase_icon = []
-        for i in range(len(phase_dict)):
-            rng  = list(phase_dict.values())[i]
-            char = list(phase_dict.keys())[i]
-            if rng[0] <= avg_moon_phase < rng[1]:
-                phase_icon.append(char)
-
-        moon['phase_icon'] = [phase_icon[0] for i in range(len(moon))]
+        phase_icon = [char for char, rng in phase_dict.items() if rng[0] <= avg_moon_phase < rng[1]]
+        moon['phase_icon'] = phase_icon[0] if phase_icon else None
 
         moon.rename(columns={old:new for old, new in zip(moon_cols, renamed_moon_cols)}, inplace=True)
         return fields[renamed_field_cols], stars[renamed_star_cols], moon[renamed_moon_cols]
 
     return fields, stars
 
+def get_alt_tracks(fields, bin_size=4, keep_fids=()):
+    '''
+    Level of detail altitude tracks of the fields made by get_data, for the altitude-time plot.
+
+    Fields scheduled tonight, and those in keep_fids, keep a row per time step. The altitudes of every other field are
+    averaged over bins of bin_size time steps, with the lowest and highest altitude of each bin kept as its envelope.
+    Binned rows are placed at the middle time step of their bin and get the status of their mean altitude. Column n is
+    the number of time steps a row covers.
+    '''
+    keep = fields['sch'] | fields['fid'].isin([str(fid) for fid in keep_fids])
+    ts_str = fields.drop_duplicates('tsid').set_index('tsid')['st']
+
+    full = fields.loc[keep, ['fid', 'st', 'tsid', 'alt', 'fS', 'sch']].copy()
+    full['altMin'] = full['alt']
+    full['altMax'] = full['alt']
+    full['n'] = 1
+
+    rest = fields.loc[~keep]
+    binned = rest.groupby([rest['fid'], (rest['tsid'] // bin_size).rename('tbin')], sort=False).agg(
+        alt=('alt', 'mean'), altMin=('alt', 'min'), altMax=('alt', 'max'),
+        tmin=('tsid', 'min'), tmax=('tsid', 'max'), n=('alt', 'size'),
+    ).reset_index()
+    # every time step has at least one field row, so its timestamp is known
+    binned['tsid'] = (binned['tmin'] + binned['tmax']) // 2
+    binned['st'] = ts_str.reindex(binned['tsid']).to_numpy()
+    binned['fS'] = np.where(binned['alt'] < 40, 'Unavailable', 'Available')
+    binned['sch'] = False
+
+    columns = ['fid', 'st', 'tsid', 'alt', 'altMin', 'altMax', 'fS', 'sch', 'n']
+    return pd.concat([full[columns], binned[columns]], ignore_index=True)
+
+
+def to_columnar(data, ref_cols=None, precision=2):
+    '''
+    Column oriented representation of a dataset made by get_data, that the web page expands back to records.
+
+    Numeric columns are stored as arrays. Everything else (strings, booleans) is dictionary encoded: the unique values
+    are stored once and each row only stores the index of its value. Columns listed in ref_cols, as {column: other},
+    are a function of another integer column, so their dictionary is indexed by that column and stores no codes at all,
+    e.g. the timestamps {'st': 'tsid'}.
+    '''
+    ref_cols = {} if ref_cols is None else ref_cols
+    columns = {}
+    for col in data.columns:
+        values = data[col]
+        if col in ref_cols:
+            ref = data[ref_cols[col]].to_numpy()
+            lookup = np.empty(ref.max()+1 if len(ref) else 0, dtype=object)
+            lookup[ref] = values.to_numpy()
+            columns[col] = {'dict': lookup.tolist(), 'ref': ref_cols[col]}
+        elif pd.api.types.is_float_dtype(values):
+            columns[col] = _float_list(values.to_numpy(dtype=float), precision)
+        elif pd.api.types.is_integer_dtype(values):
+            columns[col] = values.to_numpy().tolist()
+        else:
+            # missing values get a code of their own, their dictionary entry is null
+            codes, uniques = pd.factorize(values, use_na_sentinel=False)
+            columns[col] = {'dict': [_json_value(v) for v in uniques], 'codes': codes.tolist()}
+    return {'n': len(data), 'columns': columns}
+
+
+def _float_list(values, precision):
+    '''Rounded floats as a list, with NaNs as None so that they are written as JSON null.'''
+    values = np.round(values, precision)
+    missing = np.isnan(values)
+    if not missing.any():
+        return values.tolist()
+    values = values.astype(object)
+    values[missing] = None
+    return values.tolist()
+
+
+def _json_value(value):
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def write_columnar(data, path, ref_cols=None, precision=2):
+    '''Write a dataset made by get_data in the compact column oriented format, see to_columnar.'''
+    with open(path, 'w') as f:
+        json.dump(to_columnar(data, ref_cols, precision), f, separators=(',', ':'), allow_nan=False)
+
+
+BUNDLE_MAGIC = b'SDSB'
+BUNDLE_VERSION = 1
+
+
+def _smallest_uint(maxval):
+    return np.uint8 if maxval < 2**8 else np.uint16 if maxval < 2**16 else np.uint32
+
+
+def to_bundle(datasets, ref_cols=None, precision=2):
+    '''
+    Little-endian binary bundle of several datasets made by get_data, e.g. {'dataFields': fields, ...}, that the web page
+    reads through typed array views of the buffer without parsing the rows.
+
+    The bundle starts with the 4 byte magic, and the uint32 length of a JSON header, followed by the header itself and
+    the column buffers. The header describes, for each dataset, its number of rows and each column's type and offset
+    from the start of the buffers. Columns are encoded like in to_columnar, except that floats are stored as float32,
+    to be rounded to `precision` decimals by the reader, and dictionary codes as the smallest unsigned integer that
+    fits them. Every column buffer starts at a multiple of 4 bytes so the reader can view it in place. The precision
+    can also be given per dataset, as {name: precision}, datasets not in it use 2 decimals.
+    '''
+    ref_cols = {} if ref_cols is None else ref_cols
+    header = {'version': BUNDLE_VERSION, 'datasets': {}}
+    buffers, offset = [], 0
+
+    def add_buffer(arr):
+        nonlocal offset
+        arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+        start, raw = offset, arr.tobytes()
+        buffers.append(raw + b'\0' * (-len(raw) % 4))
+        offset += len(buffers[-1])
+        return {'type': arr.dtype.name, 'offset': start}
+
+    for name, data in datasets.items():
+        decimals = precision.get(name, 2) if isinstance(precision, dict) else precision
+        columns = {}
+        for col in data.columns:
+            values = data[col]
+            if col in ref_cols:
+                ref = data[ref_cols[col]].to_numpy()
+                lookup = np.empty(ref.max()+1 if len(ref) else 0, dtype=object)
+                lookup[ref] = values.to_numpy()
+                columns[col] = {'dict': lookup.tolist(), 'ref': ref_cols[col]}
+            elif pd.api.types.is_float_dtype(values):
+                columns[col] = add_buffer(np.round(values.to_numpy(dtype=float), decimals).astype(np.float32))
+                columns[col]['precision'] = decimals
+            elif pd.api.types.is_integer_dtype(values):
+                arr = values.to_numpy()
+                if len(arr) and arr.min() >= 0:
+                    arr = arr.astype(_smallest_uint(arr.max()))
+                else:
+                    arr = arr.astype(np.int32)
+                columns[col] = add_buffer(arr)
+            else:
+                # missing values get a code of their own, so no code is ever out of the dictionary
+                codes, uniques = pd.factorize(values, use_na_sentinel=False)
+                columns[col] = add_buffer(codes.astype(_smallest_uint(len(uniques))))
+                columns[col]['dict'] = [_json_value(v) for v in uniques]
+        header['datasets'][name] = {'n': len(data), 'columns': columns}
+
+    header = json.dumps(header, separators=(',', ':'), allow_nan=False).encode('utf-8')
+    header += b' ' * (-len(header) % 4)
+    prefix = BUNDLE_MAGIC + np.uint32(len(header)).astype('<u4').tobytes()
+    return b''.join([prefix, header] + buffers)
+
+
+def write_bundle(datasets, path, ref_cols=None, precision=2):
+    '''Write datasets made by get_data as one binary bundle, see to_bundle.'''
+    with open(path, 'wb') as f:
+        f.write(to_bundle(datasets, ref_cols, precision))
+
+
 ####################
 #    Plot priorities as histogram with selection
 ####################
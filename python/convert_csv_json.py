@@ -1,30 +1,399 @@
-import pandas as pd
+import argparse
+import gzip
+import hashlib
+import json
 import os
+import sys
+import time
+import traceback
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+from altairPlotting import get_alt_tracks, get_data, to_bundle, to_columnar, write_bundle, write_columnar
 
-from altairPlotting import get_data
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "datagen"))
+from ephemeris import cachedEphemeris
+from manifest import Manifest, fileDigest
+from starCatalog import exportTable, loadStarCatalog
+from storage import listNights, nightPath, readNight, replaceFile
 
 
 DATA_IN_DIR="../../full_data/"
 DATA_OUT_DIR="../../data/"
+OUTPUT_FILES = ("fields.json", "stars.json",  "moon.json")
+BUNDLE_FILE = "night.bin"
+INDEX_FILE = "nights.json"
+ORDER_FILE = "nightOrder.json"
+STAR_CATALOG_OUT = "starCatalog.json"
+FORMATS = ("records", "columnar", "binary")
 
+# names of the fields, stars and moon datasets in the plot spec
+DATASET_NAMES = ("dataFields", "dataStars", "dataMoon")
 
-if __name__ == "__main__":
-    if not os.path.exists(DATA_OUT_DIR):
-        os.mkdir(DATA_OUT_DIR)
+# when the star catalog is shipped separately, nights carry the ICRS to AltAz
+# rotation of every time step in place of the star data, see skyRotations
+SKY_DATASET = "skyRotation"
+# decimals kept of each dataset, rotation elements need more than positions
+PRECISION = {SKY_DATASET: 7}
+
+# level of detail altitude tracks of the fields, see get_alt_tracks
+ALTS_DATASET = "dataAlts"
+
+# when nights are sliced by time step, the row offsets of every time step in
+# each dataset, see sliceByTime
+OFFSETS_DATASET = "tsidOffsets"
+
+# columns that are a function of the time step, stored once per time step in
+# the columnar and binary formats
+REF_COLS = {"st": "tsid"}
+
+
+def outputPaths(mjd, outDir=DATA_OUT_DIR, format="records"):
+    """Paths of the files exported for a night."""
+    names = [BUNDLE_FILE] if format == "binary" else OUTPUT_FILES
+    return [os.path.join(outDir, str(mjd), name) for name in names]
+
+
+def nightTimeSteps(df):
+    """Time steps of a night, in the order `get_data` numbers them (tsid)."""
+    fields = df[(df.objType == "sdss field") & (df.alt > -.5)]
+    return np.sort(fields.mjdExpStart.round(6).unique())
+
+
+def skyRotations(timeSteps):
+    """ICRS to AltAz rotation matrix of each time step, flattened row by row
+    into the columns r0 to r8, indexed by tsid. The web page projects the star
+    catalog with them, one matrix product per time step."""
+    rotations = cachedEphemeris(timeSteps)["rotation"].reshape(-1, 9)
+    sky = pd.DataFrame(rotations, columns=["r%i"%i for i in range(9)])
+    sky.insert(0, "tsid", np.arange(len(sky)))
+    return sky
+
+
+def sliceByTime(datasets):
+    """Order the rows of every dataset by time step, and the offsets of each
+    time step's rows.
+
+    Rows of time step `tsid` are `offsets[tsid]` to `offsets[tsid+1]` of the
+    dataset, so the page hands the rows of the hovered time step to the plot
+    directly instead of filtering the whole night for every layer. The order
+    of the rows within a time step is kept.
+
+    Returns
+    -------
+    datasets : `dict`
+        The datasets, ordered by `tsid`, and the `OFFSETS_DATASET`, one
+        column of offsets per dataset.
+    """
+    sliced = [name for name in DATASET_NAMES if name in datasets]
+    nTimes = max([datasets[name].tsid.max()+1 for name in sliced if len(datasets[name])], default=0)
+
+    offsets = {}
+    for name in sliced:
+        datum = datasets[name].sort_values("tsid", kind="stable")
+        counts = np.bincount(datum.tsid.to_numpy(), minlength=nTimes)
+        offsets[name] = np.concatenate([[0], np.cumsum(counts)])
+        datasets[name] = datum
+    datasets[OFFSETS_DATASET] = pd.DataFrame(offsets)
+    return datasets
+
+
+def writeStarCatalog(catalogFile, outDir=DATA_OUT_DIR):
+    """Write the star catalog shared by all nights, in the columnar format."""
+    catalog = exportTable(loadStarCatalog(catalogFile))
+    write_columnar(catalog, os.path.join(outDir, STAR_CATALOG_OUT), precision=5)
+
+
+def loadIndex(outDir=DATA_OUT_DIR):
+    """Index of the bundled nights, see `bundleNight`, empty if there is none."""
+    path = os.path.join(outDir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def saveIndex(index, outDir=DATA_OUT_DIR):
+    def write(tmpPath):
+        with open(tmpPath, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+    replaceFile(os.path.join(outDir, INDEX_FILE), write)
+
+
+def bundlePaths(mjd, outDir=DATA_OUT_DIR, index=None):
+    """Paths of the bundle of a night, and its compressed siblings, listed
+    in the index. Paths of a file that does not exist when the night is not
+    in the index."""
+    entry = (index or {}).get(str(mjd))
+    if entry is None:
+        return [os.path.join(outDir, str(mjd), "missing")]
+    return [os.path.join(outDir, entry[key]["file"]) for key in ("raw", "gz") if key in entry]
+
+
+def writeNightOrder(mjds, outDir=DATA_OUT_DIR, format="records", bundle=False, index=None):
+    """Write the exported nights in calendar order, the size of each, in
+    bytes, and its format. The page prefetches the neighbours of the night it
+    shows, the entries next to it, bounds its cache by these sizes and reads
+    the format to fetch the right file directly: "bundle" for nights in the
+    bundle index, otherwise the export format.
+
+    Parameters
+    ----------
+    mjds : `list`
+        Candidate nights, those whose files do not exist are left out.
+    index : `dict`
+        Index of the bundled nights, used when `bundle` is set.
+    """
+    order = {"mjd": [], "bytes": [], "format": []}
+    for mjd in sorted(mjds):
+        # the bundle itself, not its compressed siblings
+        paths = bundlePaths(mjd, outDir, index)[:1] if bundle else outputPaths(mjd, outDir, format)
+        if all(os.path.exists(path) for path in paths):
+            order["mjd"].append(int(mjd))
+            order["bytes"].append(sum(os.path.getsize(path) for path in paths))
+            order["format"].append("bundle" if bundle else format)
+
+    def write(tmpPath):
+        with open(tmpPath, "w") as f:
+            json.dump(order, f, separators=(",", ":"))
+    replaceFile(os.path.join(outDir, ORDER_FILE), write)
 
-    for mjd in range(59305, 59670):
-        import warnings
-        warnings.simplefilter(action='ignore')
 
-        save_path = os.path.join(DATA_OUT_DIR, str(mjd))
-        if not os.path.exists(save_path):
-            os.mkdir(save_path)
+def removeBundle(entry, outDir=DATA_OUT_DIR):
+    """Remove the files of a bundle index entry that still exist."""
+    for key in ("raw", "gz"):
+        if key in entry:
+            path = os.path.join(outDir, entry[key]["file"])
+            if os.path.exists(path):
+                os.remove(path)
 
-        # Read data and preprocess
-        file = os.path.join(DATA_IN_DIR, f"mjd-{mjd}-sdss-simple-expanded-priority.csv")
-        df = pd.read_csv(file, index_col=0)
-        data = get_data(df, moon_data=True)
 
-        for name, datum in zip(("fields.json", "stars.json",  "moon.json"), data):
-            outPath = os.path.join(save_path, name)
+def nightPayload(datasets, format):
+    """Datasets of a night, keyed by their name in the plot spec, as the
+    content of a single file, and that file's extension."""
+    if format == "binary":
+        return to_bundle(datasets, ref_cols=REF_COLS, precision=PRECISION), "bin"
+    if format == "columnar":
+        payload = {name: to_columnar(datum, ref_cols=REF_COLS, precision=PRECISION.get(name, 2))
+                   for name, datum in datasets.items()}
+        return json.dumps(payload, separators=(",", ":")).encode("utf-8"), "json"
+    payload = ",".join('"%s":%s'%(name, datum.to_json(orient='records', double_precision=PRECISION.get(name, 2),
+                                                      date_unit="s"))
+                       for name, datum in datasets.items())
+    return ("{" + payload + "}").encode("utf-8"), "json"
+
+
+def _fileEntry(relPath, content):
+    return {"file": relPath, "size": len(content), "sha256": hashlib.sha256(content).hexdigest()}
+
+
+def bundleNight(mjd, datasets, outDir=DATA_OUT_DIR, format="records"):
+    """Write the datasets of a night as one file, named after the hash of its
+    content so it can be cached forever, next to its gzip compressed variant,
+    which the page inflates itself where the browser can. Bundles of previous
+    exports of the night are removed.
+
+    Returns
+    -------
+    entry : `dict`
+        Index entry of the night, the path, size and SHA256 of the bundle
+        ("raw") and of its compressed variant ("gz"), relative to
+        `outDir`, and the format of the bundle.
+    """
+    content, ext = nightPayload(datasets, format)
+    digest = hashlib.sha256(content).hexdigest()
+    relPath = os.path.join(str(mjd), "night.%s.%s"%(digest[:16], ext))
+
+    variants = {"raw": content, "gz": gzip.compress(content, compresslevel=9, mtime=0)}
+
+    nightDir = os.path.join(outDir, str(mjd))
+    entry = {"format": format}
+    for key, variant in variants.items():
+        path = relPath if key == "raw" else relPath + "." + key
+        with open(os.path.join(outDir, path), "wb") as f:
+            f.write(variant)
+        entry[key] = _fileEntry(path, variant)
+
+    keep = {os.path.basename(e["file"]) for e in entry.values() if isinstance(e, dict)}
+    for name in os.listdir(nightDir):
+        if name.startswith("night.") and name != BUNDLE_FILE and name not in keep:
+            os.remove(os.path.join(nightDir, name))
+    return entry
+
+
+def exportNight(mjd, inDir=DATA_IN_DIR, outDir=DATA_OUT_DIR, format="records", bundle=False, starCatalog=False,
+                timeSliced=False, altBin=None, keepFields=()):
+    """Export the fields, stars and moon data of a single night.
+
+    The `records` format is a list of objects, one per row. The `columnar`
+    format stores column arrays with dictionary encoded strings, see
+    `altairPlotting.to_columnar`; the web page expands it back to records.
+    The `binary` format writes all three datasets into one little-endian
+    bundle of typed columns, see `altairPlotting.to_bundle`.
+
+    When `bundle` is set the datasets are written as a single file in the
+    given format, see `bundleNight`, and its index entry is returned.
+
+    When `starCatalog` is set the star data is replaced by the rotations the
+    page projects the shared star catalog with, see `skyRotations`. When
+    `timeSliced` is set rows are ordered by time step and the offsets of each
+    time step are added, see `sliceByTime`. When `altBin` is set the level of
+    detail altitude tracks, binned over `altBin` time steps except for the
+    scheduled fields and `keepFields`, are added, see
+    `altairPlotting.get_alt_tracks`. Only bundles, binary or not, can carry
+    any of these.
+    """
+    save_path = os.path.join(outDir, str(mjd))
+    os.makedirs(save_path, exist_ok=True)
+
+    # Read data and preprocess, the page projects the shared star catalog
+    # itself so the per night star rows are not even read
+    filters = [("objType", "==", "sdss field")] if starCatalog else None
+    df = readNight("priority", mjd, root=inDir, filters=filters)
+    timeSteps = nightTimeSteps(df) if starCatalog else None
+    data = get_data(df, moon_data=True)
+
+    datasets = dict(zip(DATASET_NAMES, data))
+    if starCatalog:
+        del datasets["dataStars"]
+        datasets[SKY_DATASET] = skyRotations(timeSteps)
+    if altBin:
+        datasets[ALTS_DATASET] = get_alt_tracks(datasets["dataFields"], altBin, keepFields)
+    if timeSliced:
+        datasets = sliceByTime(datasets)
+
+    if bundle:
+        return bundleNight(mjd, datasets, outDir, format)
+
+    if format == "binary":
+        outPath, = outputPaths(mjd, outDir, format)
+        write_bundle(datasets, outPath, ref_cols=REF_COLS, precision=PRECISION)
+        return
+
+    for outPath, datum in zip(outputPaths(mjd, outDir), data):
+        if format == "columnar":
+            write_columnar(datum, outPath, ref_cols=REF_COLS)
+        else:
             datum.to_json(outPath, orient='records', double_precision=2, date_unit="s")
+
+
+def _exportNight(args):
+    """Export a night, returning the time it took and the error, if any,
+    instead of raising so that one bad night does not stop the others."""
+    mjd, inDir, outDir, format, bundle, starCatalog, timeSliced, altBin, keepFields = args
+    import warnings
+    warnings.simplefilter(action='ignore')
+
+    tstart = time.time()
+    entry, error = None, None
+    try:
+        entry = exportNight(mjd, inDir, outDir, format, bundle, starCatalog, timeSliced, altBin, keepFields)
+    except Exception:
+        error = traceback.format_exc()
+    return mjd, time.time() - tstart, entry, error
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the nightly JSON files used by the web page.")
+    parser.add_argument("-i", "--input-dir", default=DATA_IN_DIR,
+                        help="Root of the pipeline storage holding the priority stage.")
+    parser.add_argument("-o", "--output-dir", default=DATA_OUT_DIR,
+                        help="Directory in which the <mjd>/ directories are made.")
+    parser.add_argument("-s", "--start", type=int, default=None,
+                        help="First MJD to export, the first available night by default.")
+    parser.add_argument("-e", "--end", type=int, default=None,
+                        help="Last MJD to export (inclusive), the last available night by default.")
+    parser.add_argument("-n", "--processes", type=int, default=None,
+                        help="N. worker processes, all available cores by default.")
+    parser.add_argument("--format", choices=FORMATS, default="records",
+                        help="Row oriented records, compact dictionary encoded columns, or a binary bundle.")
+    parser.add_argument("-b", "--bundle", action="store_true",
+                        help="Write each night as one content-addressed file, and its gzip variant, "
+                        "listed in %s."%INDEX_FILE)
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Export all nights, even those whose data did not change.")
+    parser.add_argument("--star-catalog", default=None,
+                        help="Bright star catalog, e.g. datagen/bright_stars.csv. When given it is exported once, "
+                        "as %s, and projected by the page instead of shipping the stars of every night. "
+                        "Needs --bundle or --format binary. The nights can then be expanded without stars, "
+                        "see datagen/simplifyMJD.py --no-stars."%STAR_CATALOG_OUT)
+    parser.add_argument("-t", "--time-sliced", action="store_true",
+                        help="Order rows by time step and add the offsets of each time step, used by the "
+                        "time sliced spec (see export_base_json.py). Needs --bundle or --format binary.")
+    parser.add_argument("--alt-bin", type=int, default=None,
+                        help="Add altitude tracks for the altitude-time plot, binned over this many time steps "
+                        "except for the scheduled fields (see export_base_json.py --lod). "
+                        "Needs --bundle or --format binary.")
+    parser.add_argument("--keep-fields", nargs="*", default=[],
+                        help="Field IDs whose altitude tracks are never binned.")
+    args = parser.parse_args()
+    for flag, value in (("--star-catalog", args.star_catalog), ("--time-sliced", args.time_sliced),
+                        ("--alt-bin", args.alt_bin)):
+        if value and not (args.bundle or args.format == "binary"):
+            parser.error("%s needs --bundle or --format binary"%flag)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.star_catalog:
+        writeStarCatalog(args.star_catalog, args.output_dir)
+
+    allMJDs = listNights("priority", root=args.input_dir)
+    mjds = allMJDs
+    if args.start is not None:
+        mjds = [mjd for mjd in mjds if mjd >= args.start]
+    if args.end is not None:
+        mjds = [mjd for mjd in mjds if mjd <= args.end]
+
+    # only export nights whose priority table, or the export format, changed
+    # or whose files are missing
+    index = loadIndex(args.output_dir)
+    def outputs(mjd):
+        if args.bundle:
+            return bundlePaths(mjd, args.output_dir, index)
+        return outputPaths(mjd, args.output_dir, args.format)
+
+    manifest = Manifest(args.input_dir, force=args.force)
+    exportMode = ":".join([args.format] + [flag for flag, isSet in (("bundle", args.bundle),
+                                                                    ("stars", args.star_catalog),
+                                                                    ("sliced", args.time_sliced)) if isSet])
+    if args.alt_bin:
+        exportMode += ":alts%i:%s"%(args.alt_bin, ",".join(sorted(args.keep_fields)))
+    digests = {mjd: exportMode + ":" + fileDigest(nightPath("priority", mjd, root=args.input_dir)) for mjd in mjds}
+    stale = [mjd for mjd in mjds if manifest.isStale("export", mjd, digests[mjd], outputs(mjd))]
+    print("%i of %i nights changed"%(len(stale), len(mjds)))
+
+    tstart = time.time()
+    timings, failed = {}, {}
+    unbundled = False
+    with Pool(args.processes) as p:
+        jobs = [(mjd, args.input_dir, args.output_dir, args.format, args.bundle, args.star_catalog is not None,
+                 args.time_sliced, args.alt_bin, args.keep_fields) for mjd in stale]
+        for i, (mjd, elapsed, entry, error) in enumerate(p.imap_unordered(_exportNight, jobs), 1):
+            if error is None:
+                timings[mjd] = elapsed
+                if entry is not None:
+                    index[str(mjd)] = entry
+                elif str(mjd) in index:
+                    # the night is now in plain files, the page must not load its old bundle
+                    removeBundle(index.pop(str(mjd)), args.output_dir)
+                    unbundled = True
+                manifest.update("export", mjd, digests[mjd])
+                print("[%i/%i] mjd %i took %.2fs"%(i, len(stale), mjd, elapsed))
+            else:
+                failed[mjd] = error
+                print("[%i/%i] mjd %i FAILED"%(i, len(stale), mjd))
+    manifest.save()
+    if args.bundle or unbundled:
+        saveIndex(index, args.output_dir)
+    writeNightOrder(allMJDs, args.output_dir, args.format, args.bundle, index)
+
+    print("\nexported %i nights in %.2fs"%(len(timings), time.time()-tstart))
+    if timings:
+        slowest = max(timings, key=timings.get)
+        print("per night: mean %.2fs, slowest mjd %i %.2fs"%(
+            sum(timings.values())/len(timings), slowest, timings[slowest]))
+    for mjd in sorted(failed):
+        print("\nmjd %i failed:\n%s"%(mjd, failed[mjd]))
+    if failed:
+        sys.exit(1)
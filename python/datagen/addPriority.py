@@ -1,42 +1,88 @@
-import glob
-import pandas as pd
-import numpy
-import seaborn as sns
-import matplotlib.pyplot as plt
+"""
+Assigns priorities and completions to the fields of every expanded night.
+Scheduled fields always get the highest priority, 0.
 
+The values of each field are drawn once, for the whole schedule, and kept in
+the field registry (see fieldRegistry.py), so a field has the same values on
+every night. Nights only join against the registry.
+"""
 
-# filename = "mjd-59662-sdss-simple-expanded.csv"
+import argparse
+import time
+from multiprocessing import Pool
 
-allfiles = glob.glob("testDir/mjd*-simple-expanded.csv")
+from fieldRegistry import REGISTRY_FILE, getRegistry, registryDigest
+from manifest import Manifest, fileDigest
+from storage import listNights, nightPath, readNight, readStage, writeNight
 
-for filename in allfiles:
 
-    df = pd.read_csv(filename, index_col=0)
-    newfilename = filename.strip(".csv") + "-priority.csv"
+def addPriority(df, registry):
+    """Add `priority` and `completion` columns to an expanded night.
 
-    priority = numpy.array([-1]*len(df))
-    completion = numpy.array([-1]*len(df))
+    Parameters
+    ----------
+    df : `pandas.DataFrame`
+        Expanded night, see `expandSimple`.
+    registry : `pandas.DataFrame`
+        Field registry, see `fieldRegistry.getRegistry`.
+    """
+    isField = df.objType == "sdss field"
+    fieldIDs = df.fieldID.where(isField)
 
+    # everything that is not a field (i.e. stars) gets -1
+    priority = fieldIDs.map(registry.priority).fillna(-1).astype(int)
+    df["completion"] = fieldIDs.map(registry.completion).fillna(-1)
+
+    # give all scheduled plates high priority
+    scheduledFields = df.loc[df.scheduled==True, "fieldID"].unique()
+    priority[isField & df.fieldID.isin(scheduledFields)] = 0
     df["priority"] = priority
-    df["completion"] = completion
-
-    fields = list(set(df[df.objType=="sdss field"]["fieldID"]))
-    fieldPriority = numpy.random.choice([0,1,2,3,4,5], size=len(fields))
-    fieldCompletion = numpy.random.uniform(high=100, size=len(fields))
-
-    for field, priority, completion in zip(fields, fieldPriority, fieldCompletion):
-        # check if its scheduled
-        sched = list(df[df.fieldID==field]["scheduled"])
-        if True in sched:
-            # give all scheduled plates high priority
-            priority = 0
-        df["priority"].loc[df["fieldID"]==field] = priority
-        df["completion"].loc[df["fieldID"]==field] = completion
-
-    df.reset_index()
-    df.to_csv(newfilename)
-    # sns.scatterplot(x="fieldID", y="completion", data=df[df.objType=="sdss field"])
-    # plt.show()
-
-# import pdb; pdb.set_trace()
-# print(fields)
\ No newline at end of file
+    return df
+
+
+def doOne(mjd, registry):
+    df = readNight("expanded", mjd)
+    df = addPriority(df, registry)
+    writeNight(df, "priority", mjd)
+    return mjd
+
+
+def _doOne(args):
+    return doOne(*args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add field priorities and completions to expanded nights.")
+    parser.add_argument("-r", "--registry", default=REGISTRY_FILE,
+                        help="Field registry, created if it does not exist.")
+    parser.add_argument("-s", "--seed", type=int, default=None,
+                        help="Random seed of the registry, values are not reproducible when omitted.")
+    parser.add_argument("-n", "--processes", type=int, default=None,
+                        help="N. worker processes, all available cores by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Redo all nights, even those whose inputs did not change.")
+    args = parser.parse_args()
+
+    # the registry covers every field of the schedule
+    sched = readStage("sched", columns=["mjd", "fieldID"])
+    registry = getRegistry(sched.fieldID.unique(), args.registry, args.seed)
+
+    # only the nights whose expansion, or the registry entries of their
+    # fields, changed
+    manifest = Manifest(force=args.force)
+    nightFields = sched.groupby("mjd").fieldID.unique()
+    digests = {mjd: fileDigest(nightPath("expanded", mjd)) + ":" + registryDigest(registry, nightFields.get(mjd, []))
+               for mjd in listNights("expanded")}
+    allMJDs = [mjd for mjd, digest in digests.items()
+               if manifest.isStale("priority", mjd, digest, [nightPath("priority", mjd)])]
+    nNights = len(allMJDs)
+
+    tstart = time.time()
+    with Pool(args.processes) as p:
+        jobs = [(mjd, registry) for mjd in allMJDs]
+        for i, mjd in enumerate(p.imap_unordered(_doOne, jobs), 1):
+            print("[%i/%i] %.1fs mjd %i"%(i, nNights, time.time()-tstart, mjd))
+            manifest.update("priority", mjd, digests[mjd])
+    manifest.save()
+
+    print("took", (time.time()-tstart)/60, "minutes")
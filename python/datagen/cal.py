@@ -1,107 +1,123 @@
 """This script generates data for the Calendar visualization.
-"""
 
+Twilight, moon and dark time of every night come from nightSky.py, computed
+from the site alone, and the number of fields from the fieldIDs of the sched
+stage, so the calendar does not need the expanded per-field tables and can
+cover any range of nights, scheduled or not. Everything is written straight
+to fieldCalendar.json.
+
+Summaries of the previous run are kept in fieldCalendar.json itself and only
+the nights whose schedule changed since then are summarized again.
+"""
 
-import glob
+import argparse
+import os
 import pandas as pd
-from astropy.time import Time
-import numpy
 import time
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-
-# one file per mjd
-allFiles = glob.glob("testDir/*priority.csv")
-
-mjd = []
-moonPhase = []
-moonHours = []
-obsHours = []
-darkPercent = []
-brightPercent = []
-monthName = []
-monthInt = []
-year = []
-dayOfYear = []
-dayOfMonth = []
-nFields = []
-dateStr = []
-
-tstart = time.time()
-
-allFiles.sort()
-
-for f in allFiles:
-    df = pd.read_csv(f, index_col=0)
-
-    # discover the mjd
-    _mjd = int(numpy.floor(df["mjdExpStart"].to_numpy()[0]))
-
-    dt = Time(_mjd, format="mjd").datetime
-    dateStr.append(dt.isoformat())
-
-    mjd.append(_mjd)
-    year.append(dt.year)
-    monthInt.append(dt.month)
-    dayOfMonth.append(dt.day)
-    monthName.append(dt.strftime("%B"))
-    dayOfYear.append(dt.timetuple().tm_yday)
-
-    # get only sdss fields
-    fieldsDF = df[df.objType == "sdss field"]
-    nFields.append(len(set(fieldsDF["fieldID"])))
-
-    # use the mean moon phase as the moon phase for this mjd
-    moonPhase.append(numpy.mean(df["moonPhase"]))
-
-    # find the timestep between mjds
-    mjdSlots = numpy.array(list(set(df["mjdExpStart"].to_numpy())))
-    mjdSlots.sort()
-    # this should be something like 8 minutes
-    mjdHoursBin = numpy.mean(numpy.diff(mjdSlots))*24  # hours
-
-    # compute the difference in hourse between the first exposure
-    # and the last exposure (might be off by 8 minutes but whatever)
-    _obsHours = (mjdSlots[-1]-mjdSlots[0])*24
-    obsHours.append(_obsHours) # total number of observable hours
-
-
-
-
-    # figure out when the moons up
-    moonUp = df[df.moonAlt > 0]
-    moonUp = moonUp.groupby("mjdExpStart").mean()
-    # number of timeslots the moon is up for multiplied by duration of time slot
-    _moonHours = len(moonUp) * mjdHoursBin
-    moonHours.append(_moonHours)
-    _brightPercent = _moonHours / obsHours
-    brightPercent.append(_brightPercent)
-    darkPercent.append(1-_brightPercent)
-
-    # print(nFields)
-tend = time.time()
-print("took", (tend-tstart)/60, "minutes")
-
-calDF = {}
-calDF["mjd"] = mjd
-calDF["moonPhase"] = moonPhase
-calDF["moonHours"] = moonHours
-calDF["obsHours"] = obsHours
-calDF["darkPercent"] = darkPercent
-calDF["brightPercent"] = brightPercent
-calDF["monthName"] = monthName
-calDF["monthInt"] = monthInt
-calDF["year"] = year
-calDF["dayOfYear"] = dayOfYear
-calDF["dayOfMonth"] = dayOfMonth
-calDF["nFields"] = nFields
-calDF["dateStr"] = dateStr
-
-
-import pdb; pdb.set_trace()
-calDF.to_json("fieldCalendar.json", orient="records")
-calDF.to_csv("fieldCalendar.csv")
-
-
-# import pdb; pdb.set_trace()
\ No newline at end of file
+
+from ephemeris import APO, siteKey
+from manifest import Manifest, fileDigest
+from nightSky import TWILIGHT_ALT, nightSky
+from storage import listNights, nightPath, readStage
+
+
+CALENDAR_JSON = "fieldCalendar.json"
+MJD_EPOCH = pd.Timestamp("1858-11-17")
+
+
+def summarizeNights(mjds, sched=None):
+    """Calendar entries of many nights.
+
+    Parameters
+    ----------
+    mjds : `list`
+        MJDs of the nights.
+    sched : `pandas.DataFrame` or `None`
+        `mjd` and `fieldID` columns of the sched stage of the nights, if any.
+        Nights without fields get 0 `nFields`.
+
+    Returns
+    -------
+    calendar : `pandas.DataFrame`
+        One row per night, sorted by mjd.
+    """
+    sky = nightSky(mjds)
+
+    nFields = pd.Series(0, index=sky.index)
+    if sched is not None:
+        nFields = sched.groupby("mjd").fieldID.nunique().reindex(sky.index, fill_value=0)
+
+    dates = pd.Series(pd.to_datetime(sky.index, unit="D", origin=MJD_EPOCH), index=sky.index)
+
+    calendar = pd.DataFrame({
+        # mean illumination during the night
+        "moonPhase": sky.moonPhase,
+        "moonHours": sky.moonHours,
+        "obsHours": sky.obsHours,  # hours between twilights
+        "darkPercent": sky.darkFraction,
+        "brightPercent": 1-sky.darkFraction,
+        "monthName": dates.dt.strftime("%B"),
+        "monthInt": dates.dt.month,
+        "year": dates.dt.year,
+        "dayOfYear": dates.dt.dayofyear,
+        "dayOfMonth": dates.dt.day,
+        "nFields": nFields,
+        "dateStr": dates.dt.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+    return calendar.rename_axis("mjd").reset_index()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize nights for the calendar visualization.")
+    parser.add_argument("--start", type=int, default=None,
+                        help="First MJD of the calendar, the first scheduled night by default.")
+    parser.add_argument("--end", type=int, default=None,
+                        help="Last MJD of the calendar, the last scheduled night by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Summarize all nights, even those whose schedule did not change.")
+    args = parser.parse_args()
+
+    tstart = time.time()
+
+    scheduled = listNights("sched")
+    if not scheduled and (args.start is None or args.end is None):
+        parser.error("no scheduled nights found, give the calendar range with --start and --end")
+    start = scheduled[0] if args.start is None else args.start
+    end = scheduled[-1] if args.end is None else args.end
+    allMJDs = list(range(start, end+1))
+
+    # a night changes with its schedule, or the site and twilight of its sky
+    skyKey = "%s:%+.1f"%(siteKey(APO), TWILIGHT_ALT)
+    digests = {mjd: skyKey + ":" + (fileDigest(nightPath("sched", mjd)) if mjd in scheduled else "")
+               for mjd in allMJDs}
+    manifest = Manifest(force=args.force)
+    oldDF = pd.DataFrame()
+    if os.path.exists(CALENDAR_JSON) and not manifest.force:
+        oldDF = pd.read_json(CALENDAR_JSON, orient="records")
+    # nights missing from the previous calendar, e.g. cut off by a narrower
+    # range, are summarized again even if their schedule did not change
+    summarized = set(oldDF.mjd) if "mjd" in oldDF else set()
+    stale = [mjd for mjd, digest in digests.items()
+             if mjd not in summarized or manifest.isStale("calendar", mjd, digest, [CALENDAR_JSON])]
+    print("%i of %i nights changed"%(len(stale), len(digests)))
+
+    calDF = pd.DataFrame()
+    if stale:
+        staleScheduled = [mjd for mjd in stale if mjd in scheduled]
+        sched = readStage("sched", columns=["mjd", "fieldID"], mjds=staleScheduled) if staleScheduled else None
+        calDF = summarizeNights(stale, sched)
+
+    # keep the previous summaries of nights that are still covered and did not change
+    if "mjd" in oldDF:
+        oldDF = oldDF[oldDF.mjd.isin(allMJDs) & ~oldDF.mjd.isin(stale)]
+        calDF = pd.concat([oldDF, calDF], ignore_index=True)
+    calDF = calDF.sort_values("mjd", ignore_index=True)
+
+    calDF.to_json(CALENDAR_JSON, orient="records")
+
+    for mjd in stale:
+        manifest.update("calendar", mjd, digests[mjd])
+    manifest.save()
+
+    tend = time.time()
+    print("took", (tend-tstart)/60, "minutes")
@@ -1,130 +1,169 @@
 """
 This script computes all the items for plotting.  Locations of fields and
 stars at each timestep for each night.
+
+The moon and the Earth orientation are computed once per unique mjdExpStart,
+and cached on disk, by ephemeris.py. Fields are then placed by rotating the
+precomputed unit vectors of the field catalog (fieldCatalog.py) with the
+matrix of their timestep, over all the (field x timestep) rows of a night.
+
+Nights are independent, every worker of the pool reads the schedule of its
+night and writes the result straight to the "fields" stage of the pipeline
+storage, one partition per night, see storage.py. Nothing is sent back to,
+or concatenated in, the parent so memory use does not grow with the number
+of nights. Together the partitions make up the year-wide table, which can
+still be written out as all-sdss-fields.csv, one night at a time, with --csv.
 """
 
-import pandas as pd
-# from coordio import ICRS, Site
-from astropy.time import Time
-from astropy.coordinates import EarthLocation, AltAz, SkyCoord, get_moon
-import astroplan
-from astropy import units as u
+import argparse
 import time
 import numpy
 from multiprocessing import Pool
 
-tStart = time.time()
-
-### read in csvs and join to get ra/decs for each field
-rsFields = pd.read_csv("rsFields.csv")
-fieldCenters = rsFields.groupby("fieldid").head().reset_index()
-# drop everything but racen and deccen
-fieldCenters = fieldCenters[["racen", "deccen", "fieldid", "cadence"]]
-
-# print("cadence set", set(fieldCenters.cadence))
-
-rsSchedule = pd.read_csv("sched.csv")
-
-jointTableAll = rsSchedule.set_index("fieldID").join(fieldCenters.set_index("fieldid"))
-# jointTable["fieldID"] = jointTable.index
-jointTableAll = jointTableAll.reset_index()
-jointTableAll.rename(columns={'index':'fieldID'}, inplace=True)
-jointTableAll.sort_values(["mjdExpStart", "scheduled", "fieldID"], ascending=[True, False, True], ignore_index=True, inplace=True)
-
-
-
-# jointTable = jointTable[jointTable.mjd <= 59305]
-
-# print(len(rsSchedule), len(jointTable))
-# print(jointTable)
-
-############# get positions ###########
-
-### site info
-APO = EarthLocation.of_site("Apache Point Observatory")
-# print("APO site", APO)
-
-def doOneChunk(mjd):
-    print("on mjd", mjd)
-    jointTable = jointTableAll[jointTableAll.mjd == mjd].reset_index()
-    jointTable.drop("index", axis="columns", inplace=True)
-    allMJDs = jointTable.mjdExpStart.to_numpy()
-    astropyTimes = Time(allMJDs, format='mjd', scale='tai')
-    allRAs = jointTable.racen.to_numpy()
-    allDecs = jointTable.deccen.to_numpy()
-
-    astropyCoords = SkyCoord(
-        ra = allRAs * u.deg, dec = allDecs * u.deg,
-        frame='icrs', obstime=astropyTimes
-    )
-
-    # tstart = time.time()
-    observedCoords = astropyCoords.transform_to(AltAz(location=APO))
-    # print("took", time.time()-tstart, "for", len(observedCoords))
-
-    jointTable["alt"] = observedCoords.alt.deg
-    jointTable["az"] = observedCoords.az.deg
-    jointTable["airmass"] = observedCoords.secz
-
-    # calculate hour angle Meeus pg 94
-    # note I'm not sure i've got hour angle right!!!!
-    h = observedCoords.alt.rad  # altitude
-    phi = APO.lat.rad # latitude
-    # azimuth measured westward of south (azimuth for astropy is east of north 180 off)
-    A = observedCoords.az.rad - numpy.pi
-    A = A % 2*numpy.pi
-    haRad = numpy.arctan2(numpy.sin(A), numpy.cos(A)*numpy.sin(phi) + numpy.tan(h)*numpy.cos(phi))
-    haDeg = numpy.degrees(haRad)
-
-    jointTable["haDeg"] = haDeg
-
-    ### finally compute moon stuff
-    # print('starting moon')
-    moonCoords = get_moon(astropyTimes, location=APO)
-
-    moonRA = moonCoords.ra.deg
-    moonDec = moonCoords.dec.deg
-
-    jointTable["moonRA"] = moonRA
-    jointTable["moonDec"] = moonDec
-
-    # get moon in AltAz
-    moonObservedCoords = moonCoords.transform_to(AltAz(location=APO))
-    jointTable["moonAlt"] = moonObservedCoords.alt.deg
-    jointTable["moonAz"] = moonObservedCoords.az.deg
-
-    # calculate moon separation
-    moonSep = moonCoords.separation(observedCoords)
-    jointTable["moonSep"] = moonSep.deg
-
-    moonPhase = astroplan.moon.moon_illumination(astropyTimes)
-    jointTable["moonPhase"] = moonPhase
-    jointTable.to_csv("mjd-%i-sdss-fields.csv"%(mjd))
+from ephemeris import APO, cachedEphemeris, projectVectorRows, unitVectors
+from fieldCatalog import FIELDS_FILE, catalogVectors, getCatalog, lookupFields
+from manifest import Manifest, fileDigest
+from sharedArrays import SharedArrays, attach, attached
+from storage import listNights, nightPath, readNight, writeCSV, writeNight
+
+
+def catalogArrays(catalog):
+    """Field catalog as numeric arrays that can be shared with the workers.
+
+    Returns
+    -------
+    arrays : `dict`
+        `fieldID`, `racen`, `deccen`, `vec` (ICRS unit vectors) and `cadence`
+        arrays, cadences are codes into `cadences`, -1 when missing.
+    cadences : `list`
+        Names of the cadences.
+    """
+    arrays = {
+        "fieldID": catalog.index.to_numpy(),
+        "racen": catalog.racen.to_numpy(),
+        "deccen": catalog.deccen.to_numpy(),
+        "vec": catalogVectors(catalog),
+        "cadence": catalog.cadence.cat.codes.to_numpy(),
+    }
+    return arrays, list(catalog.cadence.cat.categories)
+
+
+def joinFieldCenters(rsSchedule, catalog, cadences):
+    """Look up the ra/decs, cadence and unit vector of each field of a
+    schedule.
+
+    Parameters
+    ----------
+    rsSchedule : `pandas.DataFrame`
+        Schedule, see sched2csv.py.
+    catalog : `dict`
+        Field catalog arrays, see `catalogArrays`.
+    cadences : `list`
+        Names of the cadence codes of the catalog.
+
+    Returns
+    -------
+    jointTable : `pandas.DataFrame`
+        Sorted schedule with `racen`, `deccen` and `cadence` columns.
+    vecs : `numpy.array`
+        ICRS unit vector of each row, shape (N rows, 3).
+    """
+    jointTableAll = rsSchedule[["fieldID"] + [c for c in rsSchedule.columns if c != "fieldID"]]
+    jointTableAll = jointTableAll.sort_values(["mjdExpStart", "scheduled", "fieldID"], ascending=[True, False, True], ignore_index=True)
+
+    # fields missing from the catalog get NaNs
+    idx, found = lookupFields(jointTableAll.fieldID.to_numpy(), catalog["fieldID"])
+    jointTableAll["racen"] = numpy.where(found, catalog["racen"][idx], numpy.nan)
+    jointTableAll["deccen"] = numpy.where(found, catalog["deccen"][idx], numpy.nan)
+    # code -1 picks the trailing NaN
+    codes = numpy.where(found, catalog["cadence"][idx], -1)
+    jointTableAll["cadence"] = numpy.append(numpy.asarray(cadences, dtype=object), numpy.nan)[codes]
+    vecs = numpy.where(found[:, numpy.newaxis], catalog["vec"][idx], numpy.nan)
+    return jointTableAll, vecs
+
+
+def computePositions(jointTable, ephem, vecs=None, location=APO):
+    """Add field alt/az/airmass/haDeg and moon columns to a schedule table.
+
+    Parameters
+    ----------
+    jointTable : `pandas.DataFrame`
+        Schedule joined with field centers, see `joinFieldCenters`.
+    ephem : `dict`
+        Ephemeris covering all `mjdExpStart` values of the table, see
+        `ephemeris.cachedEphemeris`.
+    vecs : `numpy.array` or `None`
+        ICRS unit vectors of the rows, computed from `racen` and `deccen`
+        when not given.
+    """
+    if vecs is None:
+        vecs = unitVectors(jointTable.racen.to_numpy(), jointTable.deccen.to_numpy())
+    timeIndex = numpy.searchsorted(ephem["mjdExpStart"], jointTable.mjdExpStart.to_numpy())
+    positions = projectVectorRows(vecs, timeIndex, ephem, location)
+
+    jointTable["alt"] = positions["alt"]
+    jointTable["az"] = positions["az"]
+    jointTable["airmass"] = positions["airmass"]
+    jointTable["haDeg"] = positions["haDeg"]
+
+    jointTable["moonRA"] = ephem["moonRA"][timeIndex]
+    jointTable["moonDec"] = ephem["moonDec"][timeIndex]
+    jointTable["moonAlt"] = ephem["moonAlt"][timeIndex]
+    jointTable["moonAz"] = ephem["moonAz"][timeIndex]
+    jointTable["moonSep"] = positions["moonSep"]
+    jointTable["moonPhase"] = ephem["moonPhase"][timeIndex]
     return jointTable
-# print("moon took", time.time()-tstart, "for", len(observedCoords))
-
-# import pdb; pdb.set_trace()
-
-# print(altRad)
-
-mjds = list(set(jointTableAll.mjd))
-
-mjds.sort()
-p = Pool(11)
-dfs = p.map(doOneChunk, mjds)
-finalDF = pd.concat(dfs, ignore_index=True)
-finalDF.sort_values(["mjdExpStart", "scheduled", "fieldID"], ascending=[True, False, True], ignore_index=True, inplace=True)
-finalDF.reset_index()
-finalDF.to_csv("all-sdss-fields.csv")
-# import pdb; pdb.set_trace()
-
-# jointTable.to_csv("sdss-fields.csv")
-
-tend = time.time()
-totalTime = (tend - tStart)/60
-print("took %.2f mintues"%(totalTime))
-
 
-# import pdb; pdb.set_trace()
 
-# print(observedCoords)
\ No newline at end of file
+def doOne(mjd, catalog, cadences):
+    jointTable, vecs = joinFieldCenters(readNight("sched", mjd), catalog, cadences)
+    ephem = cachedEphemeris(jointTable.mjdExpStart.to_numpy())
+    jointTable = computePositions(jointTable, ephem, vecs)
+    writeNight(jointTable, "fields", mjd)
+    return mjd
+
+
+def _doOne(args):
+    # the catalog is mapped from shared memory when the worker starts
+    mjd, cadences = args
+    return doOne(mjd, attached(), cadences)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute field positions for every scheduled night.")
+    parser.add_argument("--fields", default=FIELDS_FILE,
+                        help="Field centers and cadences, the field catalog is built from them.")
+    parser.add_argument("-n", "--processes", type=int, default=None,
+                        help="N. worker processes, all available cores by default.")
+    parser.add_argument("--csv", default=None, nargs="?", const="all-sdss-fields.csv",
+                        help="Also write the year-wide table to a CSV, all-sdss-fields.csv by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Compute all nights, even those whose inputs did not change.")
+    args = parser.parse_args()
+
+    tStart = time.time()
+
+    # only the nights whose schedule, or the field centers, changed
+    manifest = Manifest(force=args.force)
+    digests = {mjd: fileDigest(nightPath("sched", mjd), args.fields) for mjd in listNights("sched")}
+    stale = [mjd for mjd, digest in digests.items()
+             if manifest.isStale("fields", mjd, digest, [nightPath("fields", mjd)])]
+    nNights = len(stale)
+    print("%i of %i nights changed"%(nNights, len(digests)))
+
+    # the field catalog is copied into shared memory once, not sent to every task
+    catalog, cadences = catalogArrays(getCatalog(args.fields))
+    with SharedArrays(catalog) as shared, Pool(args.processes, initializer=attach, initargs=(shared.spec,)) as p:
+        jobs = [(mjd, cadences) for mjd in stale]
+        for i, mjd in enumerate(p.imap_unordered(_doOne, jobs), 1):
+            print("[%i/%i] %.1fs mjd %i"%(i, nNights, time.time()-tStart, mjd))
+            manifest.update("fields", mjd, digests[mjd])
+    manifest.save()
+
+    if args.csv is not None:
+        nRows = writeCSV("fields", args.csv, sortBy="mjdExpStart")
+        print("wrote %i rows to %s"%(nRows, args.csv))
+
+    tend = time.time()
+    totalTime = (tend - tStart)/60
+    print("took %.2f mintues"%(totalTime))
@@ -0,0 +1,302 @@
+"""
+Ephemeris engine shared by the datagen scripts.
+
+Everything that only depends on time (the moon, the orientation of the Earth)
+is computed once per unique timestep. Objects with fixed RA/Dec, fields and
+stars, are then placed on the sky by rotating their ICRS unit vectors into the
+local horizon frame with one 3x3 matrix per timestep, which numpy broadcasts
+over the (object x timestep) grid.
+
+The rotation neglects annual aberration (at most ~20 arcsec) and refraction,
+both well below the 0.01 degree precision the visualization is exported at.
+
+Ephemerides are cached on disk, one file per site and night, keyed by the
+timestep, so re-running any stage of the pipeline reuses them.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy
+from astropy.time import Time
+from astropy.coordinates import EarthLocation, AltAz, SkyCoord, get_body
+from astropy import units as u
+import astroplan
+
+from storage import replaceFile
+
+### site info
+APO = EarthLocation.of_site("Apache Point Observatory")
+
+EPHEMERIS_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ephemCache")
+
+# columns stored in the ephemeris cache, moonVec is derived from moonAlt/Az
+EPHEMERIS_KEYS = ("mjdExpStart", "rotation", "moonRA", "moonDec", "moonAlt", "moonAz", "moonPhase")
+
+
+def unitVectors(ra, dec):
+    """Cartesian unit vectors, shape (N, 3), of RA/Dec given in degrees."""
+    ra = numpy.radians(numpy.asarray(ra, dtype=float))
+    dec = numpy.radians(numpy.asarray(dec, dtype=float))
+    cosDec = numpy.cos(dec)
+    return numpy.stack([cosDec*numpy.cos(ra), cosDec*numpy.sin(ra), numpy.sin(dec)], axis=-1)
+
+
+def altAzFromVectors(vecs):
+    """Altitude and azimuth, in degrees, of AltAz frame cartesian vectors.
+
+    Astropy's AltAz cartesian axes point North, East and Up, so azimuth is
+    measured East of North.
+    """
+    x, y, z = vecs[..., 0], vecs[..., 1], vecs[..., 2]
+    alt = numpy.degrees(numpy.arctan2(z, numpy.hypot(x, y)))
+    az = numpy.degrees(numpy.arctan2(y, x)) % 360
+    return alt, az
+
+
+def hourAngle(alt, az, location=APO):
+    """Hour angle, in degrees, from altitude and azimuth (Meeus pg 94)."""
+    h = numpy.radians(alt)
+    phi = location.lat.rad
+    # azimuth measured westward of south (azimuth for astropy is east of north 180 off)
+    A = (numpy.radians(az) - numpy.pi) % (2*numpy.pi)
+    haRad = numpy.arctan2(numpy.sin(A), numpy.cos(A)*numpy.sin(phi) + numpy.tan(h)*numpy.cos(phi))
+    return numpy.degrees(haRad)
+
+
+def rotationMatrices(astropyTimes, location=APO):
+    """ICRS to AltAz rotation matrices, shape (N, 3, 3), one per time.
+
+    Each of the 6 signed ICRS axes is transformed with astropy at every time.
+    Half of the difference of opposite axes cancels the (direction independent
+    part of the) aberration, and the closest proper rotation to the resulting
+    matrix is kept.
+    """
+    axes = numpy.concatenate([numpy.eye(3), -numpy.eye(3)])
+    coords = SkyCoord(
+        x=axes[:, 0], y=axes[:, 1], z=axes[:, 2],
+        representation_type="cartesian", frame="icrs"
+    )
+    frame = AltAz(obstime=astropyTimes[:, numpy.newaxis], location=location)
+    observed = coords[numpy.newaxis, :].transform_to(frame)
+    alt = observed.alt.rad
+    az = observed.az.rad
+    vecs = numpy.stack([numpy.cos(alt)*numpy.cos(az), numpy.cos(alt)*numpy.sin(az), numpy.sin(alt)], axis=-1)
+
+    # columns are the images of the ICRS x, y and z axes
+    rot = numpy.swapaxes((vecs[:, :3] - vecs[:, 3:])/2, 1, 2)
+    U, _, Vt = numpy.linalg.svd(rot)
+    return U @ Vt
+
+
+def computeEphemeris(mjds, location=APO):
+    """Compute all time dependent quantities for the given timesteps.
+
+    Parameters
+    ----------
+    mjds : `numpy.array`
+        Unique MJD (TAI) timesteps, usually the unique `mjdExpStart` values.
+    location : `astropy.coordinates.EarthLocation`
+        Observatory location, APO by default.
+
+    Returns
+    -------
+    ephem : `dict`
+        Arrays indexed the same as `mjds`: `mjdExpStart`, `rotation` (ICRS to
+        AltAz rotation matrices) and `moonRA`, `moonDec`, `moonAlt`, `moonAz`,
+        `moonPhase` and `moonVec` (moon unit vector in the AltAz frame).
+    """
+    mjds = numpy.asarray(mjds, dtype=float)
+    astropyTimes = Time(mjds, format="mjd", scale="tai")
+
+    moonCoords = get_body("moon", astropyTimes, location=location)
+    moonObservedCoords = moonCoords.transform_to(AltAz(location=location, obstime=astropyTimes))
+    moonAlt = moonObservedCoords.alt.deg
+    moonAz = moonObservedCoords.az.deg
+
+    ephem = {}
+    ephem["mjdExpStart"] = mjds
+    ephem["rotation"] = rotationMatrices(astropyTimes, location)
+    ephem["moonRA"] = moonCoords.ra.deg
+    ephem["moonDec"] = moonCoords.dec.deg
+    ephem["moonAlt"] = moonAlt
+    ephem["moonAz"] = moonAz
+    ephem["moonPhase"] = numpy.asarray(astroplan.moon.moon_illumination(astropyTimes))
+    ephem["moonVec"] = unitVectors(moonAz, moonAlt)
+    return ephem
+
+
+def _positions(observedVecs, moonVecs, location):
+    """Columns derived from AltAz frame vectors of objects and the moon."""
+    alt, az = altAzFromVectors(observedVecs)
+    cosSep = numpy.clip(numpy.sum(observedVecs*moonVecs, axis=-1), -1, 1)
+
+    positions = {}
+    positions["alt"] = alt
+    positions["az"] = az
+    with numpy.errstate(divide="ignore"):
+        positions["airmass"] = 1/numpy.sin(numpy.radians(alt))
+    positions["haDeg"] = hourAngle(alt, az, location)
+    positions["moonSep"] = numpy.degrees(numpy.arccos(cosSep))
+    return positions
+
+
+def projectRows(ra, dec, timeIndex, ephem, location=APO):
+    """Positions of objects each observed at a single timestep.
+
+    Parameters
+    ----------
+    ra : `numpy.array`
+        Right ascensions, in degrees, one per row.
+    dec : `numpy.array`
+        Declinations, in degrees, one per row.
+    timeIndex : `numpy.array`
+        Index, into the ephemeris, of the timestep of each row.
+    ephem : `dict`
+        Ephemeris, see `computeEphemeris`.
+
+    Returns
+    -------
+    positions : `dict`
+        `alt`, `az`, `airmass`, `haDeg` and `moonSep` arrays, one value per row.
+    """
+    return projectVectorRows(unitVectors(ra, dec), timeIndex, ephem, location)
+
+
+def projectVectorRows(vecs, timeIndex, ephem, location=APO):
+    """Same as `projectRows` for objects given by their ICRS unit vectors,
+    shape (N rows, 3), e.g. the precomputed ones of the field catalog."""
+    observedVecs = numpy.einsum("nij,nj->ni", ephem["rotation"][timeIndex], vecs)
+    return _positions(observedVecs, ephem["moonVec"][timeIndex], location)
+
+
+def projectGrid(ra, dec, ephem, location=APO):
+    """Positions of objects at every timestep of the ephemeris.
+
+    Same as `projectRows` except the returned arrays have the shape
+    (N timesteps, N objects).
+    """
+    return projectVectorGrid(unitVectors(ra, dec), ephem, location)
+
+
+def projectVectorGrid(vecs, ephem, location=APO):
+    """Same as `projectGrid` for objects given by their ICRS unit vectors,
+    shape (N objects, 3)."""
+    observedVecs = numpy.einsum("tij,nj->tni", ephem["rotation"], vecs)
+    return _positions(observedVecs, ephem["moonVec"][:, numpy.newaxis], location)
+
+
+def siteKey(location):
+    """Name of a site in the ephemeris cache, built from its geodetic coords."""
+    lon, lat, height = location.to_geodetic()
+    return "site_%.5f_%.5f_%.0f"%(lon.deg, lat.deg, height.to_value(u.m))
+
+
+class EphemerisCache:
+    """Ephemerides cached on disk and, with LRU eviction, in memory.
+
+    Entries are keyed by (site, timestep). Timesteps are rounded to a
+    microday and grouped into one `.npz` file per site and night, of which at
+    most `maxNights` are held in memory at once.
+
+    Parameters
+    ----------
+    cacheDir : `str`
+        Root directory of the on-disk cache.
+    location : `astropy.coordinates.EarthLocation`
+        Observatory location, APO by default.
+    maxNights : `int`
+        Maximal number of nights kept in memory.
+    """
+    def __init__(self, cacheDir=EPHEMERIS_CACHE_DIR, location=APO, maxNights=64):
+        self.location = location
+        self.maxNights = maxNights
+        self.siteDir = os.path.join(cacheDir, siteKey(location))
+        self._nights = OrderedDict()
+
+    def _path(self, night):
+        return os.path.join(self.siteDir, "%i.npz"%night)
+
+    def _loadNight(self, night):
+        if night in self._nights:
+            self._nights.move_to_end(night)
+            return self._nights[night]
+
+        path = self._path(night)
+        if os.path.exists(path):
+            with numpy.load(path) as f:
+                entry = {key: f[key] for key in EPHEMERIS_KEYS}
+        else:
+            entry = {key: numpy.zeros((0, 3, 3)) if key == "rotation" else numpy.zeros(0)
+                     for key in EPHEMERIS_KEYS}
+
+        self._storeNight(night, entry)
+        return entry
+
+    def _storeNight(self, night, entry):
+        self._nights[night] = entry
+        self._nights.move_to_end(night)
+        while len(self._nights) > self.maxNights:
+            self._nights.popitem(last=False)
+
+    def _saveNight(self, night, entry):
+        replaceFile(self._path(night), lambda tmpPath: numpy.savez(tmpPath, **entry))
+
+    def get(self, mjds):
+        """Ephemeris of the given timesteps, computing only the missing ones.
+
+        Parameters
+        ----------
+        mjds : `numpy.array`
+            MJD (TAI) timesteps.
+
+        Returns
+        -------
+        ephem : `dict`
+            Ephemeris of the sorted unique `mjds`, see `computeEphemeris`.
+        """
+        mjds = numpy.unique(numpy.asarray(mjds, dtype=float))
+        keys = numpy.round(mjds*1e6).astype(numpy.int64)
+        nights = numpy.floor(mjds).astype(int)
+
+        entries = {night: self._loadNight(night) for night in numpy.unique(nights)}
+        missing = numpy.zeros(len(mjds), dtype=bool)
+        for night, entry in entries.items():
+            cachedKeys = numpy.round(entry["mjdExpStart"]*1e6).astype(numpy.int64)
+            inNight = nights == night
+            missing[inNight] = ~numpy.isin(keys[inNight], cachedKeys)
+
+        if missing.any():
+            computed = computeEphemeris(mjds[missing], self.location)
+            for night in numpy.unique(nights[missing]):
+                new = nights[missing] == night
+                entry = entries[night]
+                merged = {key: numpy.concatenate([entry[key], computed[key][new]]) for key in EPHEMERIS_KEYS}
+                order = numpy.argsort(merged["mjdExpStart"])
+                merged = {key: val[order] for key, val in merged.items()}
+                self._storeNight(night, merged)
+                self._saveNight(night, merged)
+                entries[night] = merged
+
+        ephem = {key: [] for key in EPHEMERIS_KEYS}
+        for night, entry in entries.items():
+            cachedKeys = numpy.round(entry["mjdExpStart"]*1e6).astype(numpy.int64)
+            idx = numpy.searchsorted(cachedKeys, keys[nights == night])
+            for key in EPHEMERIS_KEYS:
+                ephem[key].append(entry[key][idx])
+        ephem = {key: numpy.concatenate(val) for key, val in ephem.items()}
+        # keep the requested timesteps exactly, not their cached rounded copies
+        ephem["mjdExpStart"] = mjds
+        ephem["moonVec"] = unitVectors(ephem["moonAz"], ephem["moonAlt"])
+        return ephem
+
+
+_caches = {}
+
+
+def cachedEphemeris(mjds, location=APO, cacheDir=EPHEMERIS_CACHE_DIR):
+    """Ephemeris of the unique `mjds` through a cache shared by the process."""
+    key = (cacheDir, siteKey(location))
+    if key not in _caches:
+        _caches[key] = EphemerisCache(cacheDir, location)
+    return _caches[key].get(mjds)
@@ -1,140 +1,111 @@
 import pandas as pd
 # from coordio import ICRS, Site
-from astropy.time import Time
-from astropy.coordinates import EarthLocation, AltAz, SkyCoord, get_moon
-import astroplan
-from astropy import units as u
 import time
 import numpy
-from multiprocessing import Pool
 
-APO = EarthLocation.of_site("Apache Point Observatory")
+from ephemeris import cachedEphemeris, projectVectorGrid, unitVectors
+from fieldCatalog import lookupFields
+from starCatalog import loadStarCatalog
+from storage import writeNight
 
-mjds = 59418
+brightStarsDF = loadStarCatalog()
+brightStarsVecs = unitVectors(brightStarsDF.ra, brightStarsDF.dec)
 
-brightStarsDF = pd.read_csv('bright_stars.csv')
-brightStarsDF = brightStarsDF[brightStarsDF.Vmag < 4.5]
-brightStarsCoords = SkyCoord(l=brightStarsDF['GLON']*u.deg, b=brightStarsDF['GLAT']*u.deg, frame='galactic')
+print(len(brightStarsDF))
 
-print(len(brightStarsCoords))
 
+def computePositions(vecs, objNames, objTypes, magnitudes, ephem):
+    """Tidy table of the positions of many objects at every timestep.
 
-def computePositions(ra, dec, objName, objType, magnitude, astropyTimes, timeSteps):
-    astropyCoords = SkyCoord(
-        ra = ra * u.deg, dec = dec * u.deg,
-        frame='icrs', obstime=astropyTimes
-    )
-
-    # tstart = time.time()
-    observedCoords = astropyCoords.transform_to(AltAz(location=APO))
-    # print("took", time.time()-tstart, "for", len(observedCoords))
-
-    _alt = list(observedCoords.alt.deg)
-    _az = list(observedCoords.az.deg)
-    _airmass = list(observedCoords.secz)
+    All objects are projected for all timesteps of the ephemeris in one
+    array operation. Rows are ordered by object, then by timestep.
+    """
+    # time dependent terms (moon, Earth orientation) come from the shared
+    # ephemeris cache, only the objects themselves are projected here
+    positions = projectVectorGrid(vecs, ephem)
 
-    moonCoords = get_moon(astropyTimes, location=APO)
+    nObjs = len(objNames)
+    nTimes = len(ephem["mjdExpStart"])
 
-    _moonRA = list(moonCoords.ra.deg)
-    _moonDec = list(moonCoords.dec.deg)
+    def perObject(values):
+        return numpy.repeat(numpy.asarray(values), nTimes)
 
-    moonObservedCoords = moonCoords.transform_to(AltAz(location=APO))
+    def perTime(values):
+        return numpy.tile(numpy.asarray(values), nObjs)
 
-    _moonSep = moonCoords.separation(observedCoords)
-    _moonSep = list(_moonSep.deg)
+    def perRow(values):
+        # positions are (timestep, object), rows are object major
+        return values.T.ravel()
 
-    _moonPhase = astroplan.moon.moon_illumination(astropyTimes)
-    _moonPhase = list(_moonPhase)
-
-    _moonAlt = list(moonObservedCoords.alt.deg)
-    _moonAz = list(moonObservedCoords.az.deg)
-    # print("moonalt", _moonAlt)
-
-    nItems = len(_alt)
+    _alt = perRow(positions["alt"])
+    _airmass = perRow(positions["airmass"])
 
     d = {}
 
     d["alt"] = _alt
-    d["az"] = _az
+    d["az"] = perRow(positions["az"])
     d["airmass"] = _airmass
-    d["moonRA"] = _moonRA
-    d["moonDec"] = _moonDec
-    d["moonAlt"] = _moonAlt
-    d["moonAz"] = _moonAz
-    d["moonSep"] = _moonSep
-    d["moonPhase"] = _moonPhase
-    d["fieldID"] = [objName] * nItems
-    d["objType"] = [objType] * nItems
-    d["magnitude"] = [magnitude] * nItems
-    d["mjdExpStart"] = list(timeSteps)
-    d["risen"] = list(observedCoords.alt.deg > 0)
-    d["scheduled"] = [False]*nItems
-    d["observable"] = list(observedCoords.secz < 1.5)
+    d["moonRA"] = perTime(ephem["moonRA"])
+    d["moonDec"] = perTime(ephem["moonDec"])
+    d["moonAlt"] = perTime(ephem["moonAlt"])
+    d["moonAz"] = perTime(ephem["moonAz"])
+    d["moonSep"] = perRow(positions["moonSep"])
+    d["moonPhase"] = perTime(ephem["moonPhase"])
+    d["fieldID"] = perObject(objNames)
+    d["objType"] = perObject(objTypes)
+    d["magnitude"] = perObject(magnitudes)
+    d["mjdExpStart"] = perTime(ephem["mjdExpStart"])
+    d["risen"] = _alt > 0
+    d["scheduled"] = numpy.zeros(nObjs*nTimes, dtype=bool)
+    d["observable"] = _airmass < 1.5
     return pd.DataFrame(d)
 
 
-def expandSimple(df, mjd):
-
-    timeSteps = numpy.sort(numpy.array(list(set(df.mjdExpStart))))
-    astropyTimes = Time(timeSteps, format='mjd', scale='tai')
-
-    # at each timestep calculate the alt/az of stars
-    goodIndices = []
-    for t in astropyTimes:
-        observedCoords = brightStarsCoords.transform_to(AltAz(location=APO, obstime=t))
-        _keep = observedCoords.alt.deg > 0
-        goodIndices.append(_keep)
-        # print(goodInds)
-
-    goodIndices = numpy.any(goodIndices, axis=0)
+def expandSimple(df, mjd, catalog, stars=True):
+    """Write the positions of all fields, and unless `stars` is `False` of
+    all bright stars that rise, at every timestep of a night to the
+    expanded stage.
+
+    Field centers only ever come from `catalog`, a dict of the sorted
+    `fieldID` and the `vec` ICRS unit vectors of the field catalog, see
+    fieldCatalog.py.
+    """
+    ephem = cachedEphemeris(df.mjdExpStart.to_numpy())
+
+    if stars:
+        # at each timestep calculate the alt/az of stars
+        starAlts = projectVectorGrid(brightStarsVecs, ephem)["alt"]
+        goodIndices = numpy.any(starAlts > 0, axis=0)
+    else:
+        # the page projects the shared star catalog itself, see the
+        # --star-catalog option of convert_csv_json.py
+        goodIndices = numpy.zeros(len(brightStarsDF), dtype=bool)
     _brightStarsDF = brightStarsDF[goodIndices]
-    _brightStarsCoords = brightStarsCoords[goodIndices]
-    raDecStars = brightStarsCoords.transform_to("icrs")
 
-    # get unique fields
+    # get unique fields, fields missing from the catalog get NaN positions
     fields = df.groupby("fieldID").first().reset_index()
-    # fields.drop("Unnamed: 0", axis="columns", inplace=True)
-
-    ########### next dataframe to build
-    # fieldID = []
-    # mjdExpStart = []
-    # racen = []
-    # ceccen = []
-    # alt = []
-    # az = []
-    # airmass = []
-    # moonRA = []
-    # moonDec = []
-    # moonAlt = []
-    # moonAz = []
-    # moonSep = []
-    # moonPhase = []
-    # objType = []
-    # magnitude = []
-
-    dfs = []
-    for ind, field in fields.iterrows():
-        dfs.append(computePositions(field.racen, field.deccen, str(field.fieldID), "sdss field", -999, astropyTimes, timeSteps))
-
-
-    for (ind, bs), coord in zip(brightStarsDF.iterrows(), raDecStars):
-        dfs.append(computePositions(coord.ra.deg, coord.dec.deg, bs.DM, "bright star", bs.Vmag, astropyTimes, timeSteps))
-
-    jointDF = pd.concat(dfs)
-    # import pdb; pdb.set_trace()
+    idx, found = lookupFields(fields.fieldID.to_numpy(), catalog["fieldID"])
+    fieldVecs = numpy.where(found[:, numpy.newaxis], catalog["vec"][idx], numpy.nan)
+    nFields = len(fields)
+    nStars = len(_brightStarsDF)
+
+    # every field and every star that rises tonight, in one go
+    jointDF = computePositions(
+        numpy.concatenate([fieldVecs, brightStarsVecs[goodIndices]]),
+        numpy.concatenate([fields.fieldID.astype(str).to_numpy(), _brightStarsDF.DM.to_numpy()]),
+        ["sdss field"]*nFields + ["bright star"]*nStars,
+        numpy.concatenate([numpy.full(nFields, -999.0), _brightStarsDF.Vmag.to_numpy()]),
+        ephem
+    )
     print("scheduled before", numpy.sum(jointDF.scheduled))
 
+    # lastly find which were originally scheduled, a hashed lookup of the
+    # (fieldID, mjdExpStart) keys marks all of them in one go
     scheduled = df[df.scheduled==True]
-    for ind, row in scheduled.iterrows():
-        ii = (jointDF.fieldID == str(row.fieldID)) & (jointDF.mjdExpStart == row.mjdExpStart)
-        jointDF["scheduled"][ii] = True
-    # lastly find which were originally scheduled
-
-    jointDF.to_csv("testDir/mjd-%i-sdss-simple-expanded.csv"%mjd)
-# print("scheduled after", numpy.sum(jointDF.scheduled))
-
-if __name__ == "__main__":
-    mjds = 59418
-    df = pd.read_csv("mjd-%i-sdss-simple.csv"%mjds)
-    expandSimple(df)
-# print(df)
+    scheduledKeys = pd.MultiIndex.from_arrays([scheduled.fieldID.astype(str), scheduled.mjdExpStart])
+    jointKeys = pd.MultiIndex.from_arrays([jointDF.fieldID, jointDF.mjdExpStart])
+    jointDF["scheduled"] = jointKeys.isin(scheduledKeys)
+    print("scheduled after", numpy.sum(jointDF.scheduled))
+
+    writeNight(jointDF, "expanded", mjd)
+
@@ -0,0 +1,114 @@
+"""
+Catalog of the fixed per-field attributes, center and cadence, keyed by
+fieldID.
+
+Field centers never move, so their ICRS unit vectors are computed once, when
+the catalog is built from rsFields.csv, and stored with it as Parquet. Every
+stage loads the catalog once and places fields on the sky with a single
+rotation per timestep (see ephemeris.py), without redoing the trigonometry
+of the centers. The catalog is rebuilt whenever rsFields.csv changes.
+"""
+
+import os
+import pandas as pd
+import numpy
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ephemeris import unitVectors
+from manifest import fileDigest
+from storage import replaceFile
+
+
+FIELDS_FILE = "rsFields.csv"
+CATALOG_FILE = "fieldCatalog.parquet"
+
+# digest of the rsFields.csv a catalog was built from, in its Parquet metadata
+SOURCE_KEY = b"fieldCatalog.source"
+
+
+def createCatalog(fieldsFile=FIELDS_FILE):
+    """Build the catalog from the field centers and cadences.
+
+    Parameters
+    ----------
+    fieldsFile : `str`
+        CSV with the `fieldid`, `racen`, `deccen` and `cadence` of each
+        field. Only the first row of a repeated `fieldid` is kept.
+
+    Returns
+    -------
+    catalog : `pandas.DataFrame`
+        `racen`, `deccen`, `cadence` and the `x`, `y`, `z` ICRS unit vector
+        of each field, indexed by the sorted integer `fieldID`.
+    """
+    rsFields = pd.read_csv(fieldsFile)
+    rsFields = rsFields.drop_duplicates("fieldid").sort_values("fieldid")
+    vecs = unitVectors(rsFields.racen, rsFields.deccen)
+
+    catalog = pd.DataFrame({
+        "racen": rsFields.racen.to_numpy(),
+        "deccen": rsFields.deccen.to_numpy(),
+        "cadence": pd.Categorical(rsFields.cadence),
+        "x": vecs[:, 0],
+        "y": vecs[:, 1],
+        "z": vecs[:, 2],
+    }, index=pd.Index(rsFields.fieldid.to_numpy(), name="fieldID"))
+    return catalog
+
+
+def loadCatalog(path=CATALOG_FILE):
+    """Read the catalog and the digest of its source from a Parquet file."""
+    table = pq.read_table(path)
+    source = (table.schema.metadata or {}).get(SOURCE_KEY, b"").decode()
+    return table.to_pandas(), source
+
+
+def saveCatalog(catalog, source, path=CATALOG_FILE):
+    """Write the catalog, and the digest of its source, to a Parquet file."""
+    table = pa.Table.from_pandas(catalog)
+    table = table.replace_schema_metadata({**table.schema.metadata, SOURCE_KEY: source.encode()})
+    replaceFile(path, lambda tmpPath: pq.write_table(table, tmpPath))
+
+
+def getCatalog(fieldsFile=FIELDS_FILE, path=CATALOG_FILE):
+    """Load the catalog, building it again if `fieldsFile` changed."""
+    source = fileDigest(fieldsFile)
+    if os.path.exists(path):
+        catalog, catalogSource = loadCatalog(path)
+        if catalogSource == source:
+            return catalog
+
+    catalog = createCatalog(fieldsFile)
+    saveCatalog(catalog, source, path)
+    return catalog
+
+
+def catalogVectors(catalog):
+    """ICRS unit vectors of the catalog, shape (N fields, 3)."""
+    return catalog[["x", "y", "z"]].to_numpy()
+
+
+def lookupFields(fieldIDs, catalogIDs):
+    """Position of each field in the catalog.
+
+    Parameters
+    ----------
+    fieldIDs : `numpy.array`
+        Integer field IDs to look up.
+    catalogIDs : `numpy.array`
+        Sorted field IDs of the catalog, its index.
+
+    Returns
+    -------
+    idx : `numpy.array`
+        Row of each field in the catalog, only meaningful where `found`.
+    found : `numpy.array`
+        False for the fields missing from the catalog.
+    """
+    fieldIDs = numpy.asarray(fieldIDs)
+    if len(catalogIDs) == 0:
+        return numpy.zeros(len(fieldIDs), dtype=int), numpy.zeros(len(fieldIDs), dtype=bool)
+    # binary search in the sorted ids
+    idx = numpy.minimum(numpy.searchsorted(catalogIDs, fieldIDs), len(catalogIDs) - 1)
+    return idx, catalogIDs[idx] == fieldIDs
@@ -0,0 +1,85 @@
+"""
+Registry of the per-field attributes, priority and completion, that we assign
+randomly.
+
+The registry is created once for all fields in the schedule and stored as
+Parquet. Every night joins against it, so a field has the same priority and
+completion on every night and in every data product made from them.
+"""
+
+import hashlib
+import os
+import pandas as pd
+import numpy
+
+
+REGISTRY_FILE = "fieldRegistry.parquet"
+
+
+def createRegistry(fieldIDs, seed=None):
+    """Draw a priority and a completion for each of the given fields.
+
+    Parameters
+    ----------
+    fieldIDs : `list`
+        Field IDs, duplicates are ignored.
+    seed : `int` or `None`
+        Random seed, results are not reproducible when `None`.
+
+    Returns
+    -------
+    registry : `pandas.DataFrame`
+        Priority and completion columns indexed by the string `fieldID`.
+    """
+    fieldIDs = numpy.unique(numpy.asarray(fieldIDs).astype(str))
+    rng = numpy.random.default_rng(seed)
+
+    registry = pd.DataFrame({
+        "priority": rng.choice([0,1,2,3,4,5], size=len(fieldIDs)).astype(numpy.int8),
+        "completion": rng.uniform(high=100, size=len(fieldIDs)),
+    }, index=pd.Index(fieldIDs, name="fieldID"))
+    return registry
+
+
+def loadRegistry(path=REGISTRY_FILE):
+    """Read the registry from a Parquet file."""
+    return pd.read_parquet(path)
+
+
+def saveRegistry(registry, path=REGISTRY_FILE):
+    """Write the registry to a Parquet file."""
+    registry.to_parquet(path)
+
+
+def getRegistry(fieldIDs, path=REGISTRY_FILE, seed=None):
+    """Load the registry, extending it with any field it does not know yet.
+
+    Existing entries are never redrawn, new fields are appended and the
+    registry is saved again.
+    """
+    if not os.path.exists(path):
+        registry = createRegistry(fieldIDs, seed)
+        saveRegistry(registry, path)
+        return registry
+
+    registry = loadRegistry(path)
+    fieldIDs = numpy.unique(numpy.asarray(fieldIDs).astype(str))
+    newFields = fieldIDs[~numpy.isin(fieldIDs, registry.index)]
+    if len(newFields) > 0:
+        # offset the seed so new fields do not repeat the original draws
+        newSeed = None if seed is None else [seed, len(registry)]
+        registry = pd.concat([registry, createRegistry(newFields, newSeed)])
+        saveRegistry(registry, path)
+    return registry
+
+
+def registryDigest(registry, fieldIDs):
+    """SHA256 digest of the registry entries of the given fields only.
+
+    Nights digest just the fields they use, so appending new fields to the
+    registry does not make every other night stale.
+    """
+    fieldIDs = numpy.unique(numpy.asarray(fieldIDs).astype(str))
+    rows = registry[registry.index.isin(fieldIDs)].sort_index()
+    hashes = pd.util.hash_pandas_object(rows, index=True).to_numpy()
+    return hashlib.sha256(hashes.tobytes()).hexdigest()
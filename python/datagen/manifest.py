@@ -0,0 +1,76 @@
+"""
+Manifest of the inputs every stage used to make every night.
+
+For each (stage, night) the manifest stores a SHA256 digest of the content of
+the input files it was made from. A stage only needs to redo the nights whose
+digest changed, or whose outputs are missing, so adding or re-scheduling a
+night does not rebuild the whole year.
+"""
+
+import hashlib
+import json
+import os
+
+from storage import DATA_DIR, replaceFile
+
+
+MANIFEST_FILE = "manifest.json"
+
+
+def fileDigest(*paths):
+    """SHA256 digest of the content of the given files, in the given order."""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Input digests of each night of each stage.
+
+    Parameters
+    ----------
+    root : `str`
+        Directory in which the manifest is kept, the pipeline storage root by
+        default.
+    force : `bool`
+        When `True` every night is considered stale.
+    """
+    def __init__(self, root=DATA_DIR, force=False):
+        self.path = os.path.join(root, MANIFEST_FILE)
+        self.force = force
+        self.entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+
+    def isStale(self, stage, mjd, digest, outputs=()):
+        """True if the night has to be remade.
+
+        Parameters
+        ----------
+        stage : `str`
+            Name of the stage.
+        mjd : `int`
+            Night.
+        digest : `str`
+            Digest of the current inputs of the night, see `fileDigest`.
+        outputs : `list`
+            Files the stage makes for this night, the night is stale if any
+            of them are missing.
+        """
+        if self.force or not all(os.path.exists(output) for output in outputs):
+            return True
+        return self.entries.get(stage, {}).get(str(mjd)) != digest
+
+    def update(self, stage, mjd, digest):
+        """Record the digest of the inputs a night was made from."""
+        self.entries.setdefault(stage, {})[str(mjd)] = digest
+
+    def save(self):
+        def write(tmpPath):
+            with open(tmpPath, "w") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+        replaceFile(self.path, write)
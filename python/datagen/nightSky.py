@@ -0,0 +1,191 @@
+"""
+Twilight, moon rise/set and dark time of whole nights, from the site alone.
+
+The sun and the moon are placed with the low precision formulae of the
+Astronomical Almanac (sun ~0.01 deg, moon ~0.3 deg), which are plain numpy
+and evaluate every night of a multi-year range at once. That is plenty for
+the calendar: a 0.3 deg error moves moon rise and set by about a minute.
+
+The night of an MJD is the one whose local midnight falls on that MJD, the
+same night the schedule files it under. Nights are sampled every
+`SAMPLE_MINUTES` around local midnight; twilight and moon rise/set are
+interpolated between samples.
+
+Results are cached on disk, one row per night, next to the ephemerides (see
+ephemeris.py), so only nights that were never computed before are.
+"""
+
+import os
+
+import numpy
+import pandas as pd
+
+from ephemeris import APO, EPHEMERIS_CACHE_DIR, siteKey
+from storage import replaceFile
+
+# sun altitude at which the night starts and ends, the roboscheduler default
+TWILIGHT_ALT = -15
+SAMPLE_MINUTES = 2
+
+NIGHT_SKY_COLUMNS = ("twilightStart", "twilightEnd", "moonRise", "moonSet",
+                     "moonPhase", "obsHours", "moonHours", "darkFraction")
+
+J2000 = 51544.5  # MJD
+
+
+def sunPosition(mjds):
+    """Ecliptic longitude and RA/Dec of the sun, in degrees."""
+    n = mjds - J2000
+    L = 280.460 + 0.9856474*n
+    g = numpy.radians(357.528 + 0.9856003*n)
+    lon = L + 1.915*numpy.sin(g) + 0.020*numpy.sin(2*g)
+    ra, dec = _eclipticToEquatorial(lon, numpy.zeros_like(lon), n)
+    return lon, ra, dec
+
+
+def moonPosition(mjds):
+    """Ecliptic longitude and latitude, RA/Dec and horizontal parallax of
+    the moon, in degrees."""
+    n = mjds - J2000
+    T = n/36525
+
+    def sin(a, b):
+        return numpy.sin(numpy.radians(a + b*T))
+
+    def cos(a, b):
+        return numpy.cos(numpy.radians(a + b*T))
+
+    lon = (218.32 + 481267.881*T
+           + 6.29*sin(135.0, 477198.87) - 1.27*sin(259.3, -413335.36)
+           + 0.66*sin(235.7, 890534.22) + 0.21*sin(269.9, 954397.74)
+           - 0.19*sin(357.5, 35999.05) - 0.11*sin(186.5, 966404.03))
+    lat = (5.13*sin(93.3, 483202.02) + 0.28*sin(228.2, 960400.89)
+           - 0.28*sin(318.3, 6003.15) - 0.17*sin(217.6, -407332.21))
+    parallax = (0.9508 + 0.0518*cos(135.0, 477198.87) + 0.0095*cos(259.3, -413335.36)
+                + 0.0078*cos(235.7, 890534.22) + 0.0028*cos(269.9, 954397.74))
+    ra, dec = _eclipticToEquatorial(lon, lat, n)
+    return lon, lat, ra, dec, parallax
+
+
+def _eclipticToEquatorial(lon, lat, n):
+    eps = numpy.radians(23.439 - 0.0000004*n)
+    lon, lat = numpy.radians(lon), numpy.radians(lat)
+    ra = numpy.arctan2(numpy.sin(lon)*numpy.cos(eps) - numpy.tan(lat)*numpy.sin(eps), numpy.cos(lon))
+    dec = numpy.arcsin(numpy.sin(lat)*numpy.cos(eps) + numpy.cos(lat)*numpy.sin(eps)*numpy.sin(lon))
+    return numpy.degrees(ra) % 360, numpy.degrees(dec)
+
+
+def altitude(ra, dec, mjds, location=APO):
+    """Geocentric altitude, in degrees, of RA/Dec at the given times."""
+    lst = numpy.radians(280.46061837 + 360.98564736629*(mjds - J2000) + location.lon.deg)
+    ha = lst - numpy.radians(ra)
+    phi = location.lat.rad
+    dec = numpy.radians(dec)
+    return numpy.degrees(numpy.arcsin(numpy.sin(phi)*numpy.sin(dec) + numpy.cos(phi)*numpy.cos(dec)*numpy.cos(ha)))
+
+
+def _crossing(t, alt, level, rising):
+    """Time alt first crosses level, upwards or downwards, NaN if it does not.
+
+    `t` and `alt` have the shape (N nights, N samples).
+    """
+    above = alt > level
+    cross = above[:, 1:] & ~above[:, :-1] if rising else ~above[:, 1:] & above[:, :-1]
+    found = cross.any(axis=1)
+    i = numpy.argmax(cross, axis=1)
+    rows = numpy.arange(len(t))
+    a0, a1 = alt[rows, i], alt[rows, i+1]
+    t0, t1 = t[rows, i], t[rows, i+1]
+    tCross = t0 + (level - a0)/(a1 - a0)*(t1 - t0)
+    return numpy.where(found, tCross, numpy.nan)
+
+
+def computeNightSky(mjds, location=APO, twilight=TWILIGHT_ALT, sampleMinutes=SAMPLE_MINUTES):
+    """Twilight, moon and dark time of the given nights.
+
+    Parameters
+    ----------
+    mjds : `numpy.array`
+        Integer MJDs of the nights.
+    location : `astropy.coordinates.EarthLocation`
+        Observatory location, APO by default.
+    twilight : `float`
+        Sun altitude, in degrees, between which the night is observable.
+    sampleMinutes : `float`
+        Time between samples of the sun and moon altitude.
+
+    Returns
+    -------
+    nights : `pandas.DataFrame`
+        One row per night, indexed by `mjd`, with the `twilightStart` and
+        `twilightEnd` of the night and the first `moonRise` and `moonSet` of
+        the day around it, all as MJDs, NaN when they do not happen. The
+        `moonPhase` is the mean illuminated fraction of the moon, `obsHours`
+        the time between the twilights, `moonHours` the part of it the moon
+        is up and `darkFraction` the part it is not.
+    """
+    mjds = numpy.asarray(mjds, dtype=int)
+    # local midnight, and a day of samples centered on it
+    midnight = mjds + (-location.lon.deg/360) % 1
+    step = sampleMinutes/60/24
+    offsets = numpy.arange(-0.5, 0.5 + step/2, step)
+    t = midnight[:, numpy.newaxis] + offsets
+
+    sunLon, sunRA, sunDec = sunPosition(t)
+    sunAlt = altitude(sunRA, sunDec, t, location)
+
+    moonLon, moonLat, moonRA, moonDec, parallax = moonPosition(t)
+    moonAlt = altitude(moonRA, moonDec, t, location)
+    # topocentric altitude, the moon is close enough for parallax to matter
+    moonAlt -= numpy.degrees(numpy.arcsin(numpy.sin(numpy.radians(parallax))*numpy.cos(numpy.radians(moonAlt))))
+
+    # illuminated fraction from the sun-moon elongation
+    cosElong = numpy.cos(numpy.radians(moonLat))*numpy.cos(numpy.radians(moonLon - sunLon))
+    illumination = (1 - cosElong)/2
+
+    dark = sunAlt < twilight
+    nDark = dark.sum(axis=1)
+    moonUp = moonAlt > 0
+    # nights that never get dark have no moon or dark time, not NaN
+    perDark = numpy.maximum(nDark, 1)
+    brightFraction = (dark & moonUp).sum(axis=1)/perDark
+    moonPhase = numpy.where(dark, illumination, 0).sum(axis=1)/perDark
+
+    twilightStart = _crossing(t, sunAlt, twilight, rising=False)
+    twilightEnd = _crossing(t, sunAlt, twilight, rising=True)
+    obsHours = (twilightEnd - twilightStart)*24
+    # without both twilights count the dark samples instead
+    obsHours = numpy.where(numpy.isnan(obsHours), nDark*sampleMinutes/60, obsHours)
+
+    nights = pd.DataFrame({
+        "twilightStart": twilightStart,
+        "twilightEnd": twilightEnd,
+        "moonRise": _crossing(t, moonAlt, 0, rising=True),
+        "moonSet": _crossing(t, moonAlt, 0, rising=False),
+        "moonPhase": moonPhase,
+        "obsHours": obsHours,
+        "moonHours": brightFraction*obsHours,
+        "darkFraction": 1 - brightFraction,
+    }, index=pd.Index(mjds, name="mjd"))
+    return nights
+
+
+def nightSkyPath(location=APO, twilight=TWILIGHT_ALT, cacheDir=EPHEMERIS_CACHE_DIR):
+    return os.path.join(cacheDir, siteKey(location), "nightSky_%+.1f.parquet"%twilight)
+
+
+def nightSky(mjds, location=APO, twilight=TWILIGHT_ALT, cacheDir=EPHEMERIS_CACHE_DIR):
+    """Same as `computeNightSky`, only computing nights not cached on disk.
+
+    Returns the rows of the sorted unique `mjds`.
+    """
+    mjds = numpy.unique(numpy.asarray(mjds, dtype=int))
+    path = nightSkyPath(location, twilight, cacheDir)
+    cached = pd.read_parquet(path) if os.path.exists(path) else computeNightSky([], location, twilight)
+
+    missing = mjds[~numpy.isin(mjds, cached.index)]
+    if len(missing):
+        cached = pd.concat([cached, computeNightSky(missing, location, twilight)]).sort_index()
+        replaceFile(path, cached.to_parquet)
+
+    return cached.loc[mjds]
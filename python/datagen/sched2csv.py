@@ -1,24 +1,28 @@
 """
 The script takes the output files from the querySchedule.py script, organizes
-them into csvs.
+them into a table, the "sched" stage of the pipeline storage (see storage.py).
+
+querySchedule.py writes two files per night, `<mjd>-short.dat` with the
+scheduled field of each slot and `<mjd>-long.dat` with all the optional ones.
+Files are paired by their MJD and each pair is parsed, line by line, by a
+worker that writes its night straight to storage. Memory use does not grow
+with the number of nights.
 """
 
+import argparse
+import glob
+import os
+import time
 import numpy
 import pandas as pd
-import glob
-from astropy.time import Time
+from multiprocessing import Pool
+
+from manifest import Manifest, fileDigest
+from storage import nightPath, writeNight
 
 HoursPerDay = 24
 MinutesPerHour = 60
 
-_mjd = []
-_fieldID = []
-_scheduled = []
-_mjdExptime = []
-_mjdExpStart = []
-_mjdNightStart = []
-_mjdNightEnd = []
-
 
 def parseLine(line):
     # print("line", line)
@@ -35,95 +39,141 @@ def parseLine(line):
 
 
 def parseFiles(shortf, longf):
-    # with open(shortf, "r") as f:
-    #     slines = f.readlines()
-    # with open(longf, "r") as f:
-    #     llines = f.readlines()
-    # print("on", shortf)
-
+    """Parse the short and long file of a night into a typed table.
+
+    Files are streamed a line at a time and every line is expanded into one
+    row per field.
+    """
+    # start from empty typed arrays so that empty files make an empty table
+    nightStart, nightEnd, expStart, exptime = [[numpy.zeros(0)] for i in range(4)]
+    fieldID = [numpy.zeros(0, dtype=numpy.int32)]
+    scheduled = [numpy.zeros(0, dtype=bool)]
     for isSched, fname in zip([True, False], [shortf, longf]):
         with open(fname, "r") as f:
-            lines = f.readlines()
-        for line in lines:
-            mjdStart, mjdEnd, mjd, exp, fields = parseLine(line)
-            for field in fields:
-                _mjd.append(int(numpy.floor(mjd)))
-                _mjdNightStart.append(mjdStart)
-                _mjdNightEnd.append(mjdEnd)
-                _mjdExpStart.append(mjd)
-                _fieldID.append(field) # sfields
-                _scheduled.append(isSched)
-                _mjdExptime.append(exp)
-
-
-    # for sline, lline in zip(slines, llines):
-    #     mjd, exp, sfield = parseLine(sline)
-    #     assert len(sfield) == 1
-    #     _mjd.append(int(numpy.floor(mjd)))
-    #     _mjdExpStart.append(mjd)
-    #     _fieldID.append(sfield[0]) # sfields
-    #     _scheduled.append(True)
-    #     _mjdExptime.append(exp)
-    #     mjd2, exp2, fields = parseLine(lline)
-    #     # assert(mjd==mjd2)
-    #     # assert(exp2==exp)
-    #     if sfield[0] in fields:
-    #         print("removing field")
-    #         fields.remove(sfield[0])  # don't double count the scheduled field
-    #     for field in fields:
-    #         _mjd.append(int(numpy.floor(mjd2)))
-    #         _mjdExpStart.append(mjd2)
-    #         _fieldID.append(field)
-    #         _scheduled.append(False)
-    #         _mjdExptime.append(exp2)
-
-if __name__ == "__main__":
-    longFiles = glob.glob("rawdata/*long.dat")
-    shortFiles = glob.glob("rawdata/*short.dat")
-
-    longFiles.sort()
-    shortFiles.sort()
-
-    for shortFile, longFile in zip(shortFiles, longFiles):
-        parseFiles(shortFile, longFile)
+            for line in f:
+                if not line.strip():
+                    continue
+                mjdStart, mjdEnd, mjd, exp, fields = parseLine(line)
+                nFields = len(fields)
+                nightStart.append(numpy.full(nFields, mjdStart))
+                nightEnd.append(numpy.full(nFields, mjdEnd))
+                expStart.append(numpy.full(nFields, mjd))
+                exptime.append(numpy.full(nFields, exp))
+                fieldID.append(numpy.array(fields, dtype=numpy.int32))
+                scheduled.append(numpy.full(nFields, isSched))
 
     d = {}
-    d["mjd"] = _mjd
-    d["mjdNightStart"] = _mjdNightStart
-    d["mjdNightEnd"] = _mjdNightEnd
-    d["mjdExpStart"] = _mjdExpStart
-    d["mjdExptime"] = _mjdExptime
-    d["fieldID"] = _fieldID
-    d["scheduled"] = _scheduled
-
-    df = pd.DataFrame(d)
-
-    print("df len", len(df))
-    # look for repeated fieldids for the same mjdExpStart
-    allStartTimes = set(df.mjdExpStart)
-    for startTime in allStartTimes:
-        schedID = df[(df.mjdExpStart == startTime) & (df.scheduled == True)]["fieldID"]
-        if len(schedID) != 1:
-            continue
-        nonSchedID = df[(df.mjdExpStart == startTime) & (df.scheduled == False)]["fieldID"]
-        dup = nonSchedID[nonSchedID == int(schedID)]
-        if len(dup) == 0:
-            continue
-        df.drop(dup.index, inplace=True)
-        # import pdb; pdb.set_trace()
-        # df.drop(nonSchedID)
-
-        # print("nonSchedID", len(nonSchedID))
-    # print(allStartTimes)
-    # print("df after", len(df))
-    # for startTime in allStartTimes:
-    #     schedID = df[(df.mjdExpStart == startTime) & (df.scheduled == True)]["fieldID"]
-    #     if len(schedID) != 1:
-    #         continue
-    #     nonSchedID = df[(df.mjdExpStart == startTime) & (df.scheduled == False)]["fieldID"]
-    #     dup = nonSchedID[nonSchedID == int(schedID)]
-    #     assert len(dup) == 0
-
-    df.to_csv("sched.csv", index=False)
+    d["mjdNightStart"] = numpy.concatenate(nightStart)
+    d["mjdNightEnd"] = numpy.concatenate(nightEnd)
+    d["mjdExpStart"] = numpy.concatenate(expStart)
+    d["mjdExptime"] = numpy.concatenate(exptime)
+    d["fieldID"] = numpy.concatenate(fieldID)
+    d["scheduled"] = numpy.concatenate(scheduled)
+    d["mjd"] = numpy.floor(d["mjdExpStart"]).astype(numpy.int32)
+    return pd.DataFrame(d)
+
+
+def pairFiles(rawDir):
+    """Pair the short and long files of each night by their MJD.
+
+    Returns
+    -------
+    pairs : `dict`
+        (short, long) file pairs keyed by MJD.
+    unpaired : `list`
+        Files whose partner is missing, or whose name does not start with
+        an MJD.
+    """
+    unpaired = []
+
+    def byMJD(mode):
+        files = {}
+        for f in glob.glob(os.path.join(rawDir, "*%s.dat"%mode)):
+            try:
+                files[int(os.path.basename(f).split("-")[0])] = f
+            except ValueError:
+                unpaired.append(f)
+        return files
+
+    shortFiles = byMJD("short")
+    longFiles = byMJD("long")
+
+    pairs = {mjd: (shortFiles[mjd], longFiles[mjd]) for mjd in sorted(shortFiles.keys() & longFiles.keys())}
+    unpaired += [f for mjd, f in shortFiles.items() if mjd not in longFiles]
+    unpaired += [f for mjd, f in longFiles.items() if mjd not in shortFiles]
+    return pairs, sorted(unpaired)
+
+
+def removeDuplicates(df):
+    """Drop optional entries that duplicate the scheduled field of their slot.
+
+    One anti-join on the (mjdExpStart, fieldID) keys of the scheduled fields,
+    so it takes linear time. Slots without exactly one scheduled field are
+    left untouched.
+
+    Returns
+    -------
+    df : `pandas.DataFrame`
+        Schedule without the duplicates.
+    nRemoved : `pandas.Series`
+        Number of removed duplicates, indexed by mjd.
+    """
+    sched = df.loc[df.scheduled, ["mjdExpStart", "fieldID"]]
+    nSched = sched.mjdExpStart.map(sched.mjdExpStart.value_counts())
+    sched = sched[nSched == 1]
+
+    schedKeys = pd.MultiIndex.from_frame(sched)
+    keys = pd.MultiIndex.from_frame(df[["mjdExpStart", "fieldID"]])
+    dup = ~df.scheduled & keys.isin(schedKeys)
+
+    nRemoved = dup.groupby(df.mjd).sum()
+    return df[~dup], nRemoved
+
+
+def doOne(mjd, pair):
+    shortFile, longFile = pair
+    df = parseFiles(shortFile, longFile)
+    # the night is the one of the files, so no two workers write the same
+    # partition even if some exposures start past a day boundary
+    df["mjd"] = mjd
+    nParsed = len(df)
+    df, nRemoved = removeDuplicates(df)
+    writeNight(df, "sched", mjd)
+    return nParsed, int(nRemoved.sum())
+
+
+def _doOne(args):
+    return doOne(*args)
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parse roboscheduler output into the sched stage.")
+    parser.add_argument("-i", "--input", default="rawdata",
+                        help="Directory with the <mjd>-short.dat and <mjd>-long.dat files.")
+    parser.add_argument("-n", "--processes", type=int, default=None,
+                        help="N. worker processes, all available cores by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Parse all nights, even those whose files did not change.")
+    args = parser.parse_args()
+
+    pairs, unpaired = pairFiles(args.input)
+    for f in unpaired:
+        print("[WARN] no partner file, or no MJD in the name, of", f, "skipping it")
+
+    # only parse the nights whose raw files changed since the last run
+    manifest = Manifest(force=args.force)
+    digests = {mjd: fileDigest(*pair) for mjd, pair in pairs.items()}
+    stale = [mjd for mjd in pairs if manifest.isStale("sched", mjd, digests[mjd], [nightPath("sched", mjd)])]
+    print("%i of %i nights changed"%(len(stale), len(pairs)))
+
+    tstart = time.time()
+    nTotal = 0
+    with Pool(args.processes) as p:
+        results = p.imap(_doOne, [(mjd, pairs[mjd]) for mjd in stale])
+        for mjd, (nParsed, nRemoved) in zip(stale, results):
+            nTotal += nParsed
+            print("mjd %i parsed %i rows, removed %i duplicates"%(mjd, nParsed, nRemoved))
+            manifest.update("sched", mjd, digests[mjd])
+    manifest.save()
+
+    print("parsed %i rows of %i nights in %.2f minutes"%(nTotal, len(stale), (time.time()-tstart)/60))
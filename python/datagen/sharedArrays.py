@@ -0,0 +1,89 @@
+"""
+Numpy arrays shared, without copies, between the processes of a pool.
+
+The parent copies the arrays into `multiprocessing.shared_memory` blocks
+once, and passes only their names, dtypes and shapes to the workers, which
+map the same memory as read-only numpy arrays:
+
+    with SharedArrays({"x": x}) as shared:
+        with Pool(initializer=attach, initargs=(shared.spec,)) as p:
+            ...
+
+and in the worker `attached()["x"]` is a view of `x`.
+"""
+
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy
+
+
+class SharedArrays:
+    """Copies of numpy arrays in shared memory, owned by this process.
+
+    The blocks are released when the context exits, after the pool that
+    uses them has been closed.
+
+    Parameters
+    ----------
+    arrays : `dict`
+        Numeric numpy arrays, by name.
+    """
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, arr in arrays.items():
+            arr = numpy.ascontiguousarray(arr)
+            # zero sized blocks are not allowed
+            block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            numpy.ndarray(arr.shape, arr.dtype, buffer=block.buf)[...] = arr
+            self.blocks.append(block)
+            self.spec[name] = (block.name, arr.dtype.str, arr.shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+_blocks = []
+_arrays = {}
+
+
+def _attachBlock(name):
+    """Open an existing block without making this process its owner."""
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # before 3.13 opening a block registers it with the resource tracker the
+    # workers share with the parent, and unregistering it here would drop the
+    # registration of the parent too, so skip registering it at all
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach(spec):
+    """Map the arrays of a `SharedArrays.spec` into this process, usually
+    the initializer of a pool."""
+    for name, (blockName, dtype, shape) in spec.items():
+        block = _attachBlock(blockName)
+        arr = numpy.ndarray(shape, numpy.dtype(dtype), buffer=block.buf)
+        arr.flags.writeable = False
+        # the block has to outlive the view
+        _blocks.append(block)
+        _arrays[name] = arr
+
+
+def attached():
+    """Arrays mapped by `attach`, by name."""
+    return _arrays
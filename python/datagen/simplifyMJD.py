@@ -2,45 +2,75 @@ import pandas as pd
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
 pd.set_option('display.max_rows', None)
-import sys
-import glob
+import argparse
 from expandSimple import expandSimple
+from fieldCatalog import FIELDS_FILE, catalogVectors, getCatalog
+from manifest import Manifest, fileDigest
+from sharedArrays import SharedArrays, attach, attached
+from storage import listNights, nightPath, readNight
 from multiprocessing import Pool
 
 # 59418
 
-def doOne(filename):
-    print("doing file ------------------")
-    print(filename)
+def doOne(mjd, catalog, stars=True):
+    print("doing mjd ------------------")
+    print(mjd)
     print("-------------------\n\n")
-    df = pd.read_csv(filename)
-    mjd = int(filename.split("-")[-3])
+    # only the columns expandSimple needs are read from the fields stage,
+    # field centers come from the field catalog
+    df = readNight("fields", mjd, columns=["fieldID", "mjdExpStart", "scheduled"])
     print("n fields", len(set(df.fieldID)))
     df = df.groupby(["fieldID", "mjdExpStart"]).mean().reset_index()
-    df = df.sort_values(["fieldID", "mjdExpStart"]).reset_index()
-    # df = df[["fieldID", "mjdExpStart", "alt", "az"]]
+    df = df.sort_values(["fieldID", "mjdExpStart"]).reset_index(drop=True)
 
-    dropCols = ["Unnamed: 0", "haDeg", "index"]
+    expandSimple(df, mjd, catalog, stars)
 
-    df.drop(dropCols, axis="columns", inplace=True)
+    print("done with mjd ------------------")
+    print(mjd)
+    print("-------------------\n\n")
 
-    expandSimple(df, mjd)
 
-    print("done with file file ------------------")
-    print(filename)
-    print("-------------------\n\n")
+def _doOne(args):
+    # the field catalog is mapped from shared memory when the worker starts
+    mjd, stars = args
+    return doOne(mjd, attached(), stars)
 
 
 if __name__ == "__main__":
-    # mjd = sys.argv[1]
-    # print(mjd)
+    parser = argparse.ArgumentParser(description="Expand every night with the positions of all its fields and stars.")
+    parser.add_argument("--fields", default=FIELDS_FILE,
+                        help="Field centers and cadences, the field catalog is built from them.")
+    parser.add_argument("-n", "--processes", type=int, default=None,
+                        help="N. worker processes, all available cores by default.")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="Expand all nights, even those whose inputs did not change.")
+    parser.add_argument("--no-stars", action="store_true",
+                        help="Leave the bright stars out, for nights exported with the shared star catalog "
+                        "(see the --star-catalog option of convert_csv_json.py).")
+    args = parser.parse_args()
+    stars = not args.no_stars
+
+    # only expand the nights whose positions, field centers or the star catalog changed
+    manifest = Manifest(force=args.force)
+    if stars:
+        digests = {mjd: fileDigest(nightPath("fields", mjd), args.fields, "bright_stars.csv") for mjd in listNights("fields")}
+    else:
+        digests = {mjd: "nostars:" + fileDigest(nightPath("fields", mjd), args.fields) for mjd in listNights("fields")}
+    allMJDs = [mjd for mjd, digest in digests.items()
+               if manifest.isStale("expanded", mjd, digest, [nightPath("expanded", mjd)])]
+    print("%i of %i nights changed"%(len(allMJDs), len(digests)))
 
-    allFiles = glob.glob("../proc_data/mjd-*-sdss-fields.csv")
+    # doOne(59418)
 
-    # doOne("../proc_data/mjd-59418-sdss-fields.csv")
+    # the field catalog is loaded once and copied into shared memory for the workers
+    catalog = getCatalog(args.fields)
+    catalog = {"fieldID": catalog.index.to_numpy(), "vec": catalogVectors(catalog)}
+    with SharedArrays(catalog) as shared, Pool(args.processes, initializer=attach, initargs=(shared.spec,)) as p:
+        p.map(_doOne, [(mjd, stars) for mjd in allMJDs])
 
-    with Pool(11) as p:
-        p.map(doOne, allFiles)
+    for mjd in allMJDs:
+        manifest.update("expanded", mjd, digests[mjd])
+    manifest.save()
 
 
     # df.to_csv("mjd-%s-sdss-simple.csv"%mjd)
@@ -0,0 +1,51 @@
+"""
+Catalog of the bright stars drawn on the sky plot.
+
+Stars have fixed RA/Dec so the catalog is the same on every night. The
+expansion stage projects it at every timestep of a night, and the exporter
+ships it once for the whole year so that the web page can project it itself
+(see convert_csv_json.py).
+"""
+
+import pandas as pd
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+
+
+STAR_CATALOG_FILE = "bright_stars.csv"
+MAX_MAGNITUDE = 4.5
+
+
+def loadStarCatalog(path=STAR_CATALOG_FILE, maxMag=MAX_MAGNITUDE):
+    """Stars brighter than `maxMag`, with their ICRS coordinates.
+
+    Parameters
+    ----------
+    path : `str`
+        CSV with the `DM` name, `Vmag` magnitude and the `GLON` and `GLAT`
+        galactic coordinates of each star.
+    maxMag : `float`
+        Stars at or above this magnitude are dropped.
+
+    Returns
+    -------
+    catalog : `pandas.DataFrame`
+        The CSV columns and the `ra` and `dec` of each star, in degrees.
+    """
+    catalog = pd.read_csv(path)
+    catalog = catalog[catalog.Vmag < maxMag].reset_index(drop=True)
+    coords = SkyCoord(l=catalog.GLON.to_numpy()*u.deg, b=catalog.GLAT.to_numpy()*u.deg, frame="galactic")
+    icrs = coords.transform_to("icrs")
+    catalog["ra"] = icrs.ra.deg
+    catalog["dec"] = icrs.dec.deg
+    return catalog
+
+
+def exportTable(catalog):
+    """Columns of the catalog the web page needs, with the magnitudes rounded
+    the same way they are for the per-night star data."""
+    return pd.DataFrame({
+        "ra": catalog.ra.to_numpy(),
+        "dec": catalog.dec.to_numpy(),
+        "mag": catalog.Vmag.round(0).to_numpy(),
+    })
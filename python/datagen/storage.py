@@ -0,0 +1,191 @@
+"""
+Columnar storage of the intermediate products of the datagen pipeline.
+
+Each stage writes its table as Parquet, partitioned by night:
+
+    <root>/<stage>/mjd=<mjd>/part-0.parquet
+
+The stages are, in order:
+    - sched: roboscheduler output, sched2csv.py
+    - fields: field positions at each timestep, computePositions.py
+    - expanded: fields and stars at each timestep of a night, expandSimple.py
+    - priority: expanded nights with priorities and completions, addPriority.py
+
+Columns are stored typed, so there are no text round trips of floats, and
+readers can select only the columns and nights they need.
+"""
+
+import os
+import pandas as pd
+import numpy
+import pyarrow.dataset as ds
+
+
+DATA_DIR = "pipeline"
+STAGES = ("sched", "fields", "expanded", "priority")
+
+# mjdExpStart is used as a join key and has to stay float64, everything we
+# only plot is fine in single precision
+COLUMN_TYPES = {
+    "mjdNightStart": "float64",
+    "mjdNightEnd": "float64",
+    "mjdExpStart": "float64",
+    "mjdExptime": "float32",
+    "scheduled": "bool",
+    "racen": "float64",
+    "deccen": "float64",
+    "cadence": "category",
+    "alt": "float32",
+    "az": "float32",
+    "airmass": "float32",
+    "haDeg": "float32",
+    "moonRA": "float32",
+    "moonDec": "float32",
+    "moonAlt": "float32",
+    "moonAz": "float32",
+    "moonSep": "float32",
+    "moonPhase": "float32",
+    "objType": "category",
+    "magnitude": "float32",
+    "risen": "bool",
+    "observable": "bool",
+    "priority": "int8",
+    "completion": "float32",
+}
+
+
+def stagePath(stage, root=DATA_DIR):
+    """Directory holding all nights of a stage."""
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage {stage}, expected one of {STAGES}.")
+    return os.path.join(root, stage)
+
+
+def nightPath(stage, mjd, root=DATA_DIR):
+    """Parquet file holding a single night of a stage."""
+    return os.path.join(stagePath(stage, root), "mjd=%i"%mjd, "part-0.parquet")
+
+
+def replaceFile(path, write):
+    """Write a file with `write(tmpPath)` and rename it to `path`, so that
+    parallel stages never read a partial file.
+
+    The temporary file is unique to the process and keeps the extension of
+    `path`, which some writers, e.g. `numpy.savez`, depend on.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    root, ext = os.path.splitext(path)
+    tmpPath = "%s.%i.tmp%s"%(root, os.getpid(), ext)
+    write(tmpPath)
+    os.replace(tmpPath, path)
+    return path
+
+
+def typed(df):
+    """Cast the known columns of a table to their storage types."""
+    types = {col: dtype for col, dtype in COLUMN_TYPES.items() if col in df.columns}
+    return df.astype(types)
+
+
+def writeNight(df, stage, mjd, root=DATA_DIR):
+    """Write a single night of a stage, replacing it if it exists.
+
+    The night is stored in the partition path, an `mjd` column is not kept.
+    """
+    path = nightPath(stage, mjd, root)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df = typed(df.drop(columns="mjd", errors="ignore"))
+    df.to_parquet(path, index=False)
+    return path
+
+
+def writeStage(df, stage, root=DATA_DIR):
+    """Write a table with an `mjd` column, one partition per night."""
+    for mjd, night in df.groupby("mjd", sort=True):
+        writeNight(night, stage, mjd, root)
+
+
+def listNights(stage, root=DATA_DIR):
+    """Sorted nights (MJDs) available for a stage."""
+    path = stagePath(stage, root)
+    if not os.path.exists(path):
+        return []
+    return sorted(int(d.split("=")[1]) for d in os.listdir(path) if d.startswith("mjd="))
+
+
+def readNight(stage, mjd, columns=None, root=DATA_DIR, filters=None):
+    """Read some or all columns of a single night of a stage, optionally
+    only the rows that pass the `pyarrow.parquet` `filters`."""
+    return pd.read_parquet(nightPath(stage, mjd, root), columns=columns, filters=filters)
+
+
+def openStage(stage, root=DATA_DIR):
+    """Lazy `pyarrow.dataset.Dataset` over all nights of a stage.
+
+    The night is exposed as the `mjd` partition column.
+    """
+    return ds.dataset(stagePath(stage, root), format="parquet", partitioning="hive")
+
+
+def readStage(stage, columns=None, mjds=None, root=DATA_DIR):
+    """Read some or all columns of a stage, optionally only some nights.
+
+    Only the selected columns of the selected nights are read from disk.
+    """
+    dataset = openStage(stage, root)
+    filter = None if mjds is None else ds.field("mjd").isin(numpy.asarray(mjds).tolist())
+    return dataset.to_table(columns=columns, filter=filter).to_pandas()
+
+
+def scanStage(stage, columns=None, filter=None, sortBy=None, mjds=None, root=DATA_DIR):
+    """Lazily iterate over the nights of a stage, one night at a time.
+
+    Only a single night is in memory at once, so the whole stage can be
+    scanned, filtered and sorted however many nights it has. Nights come in
+    MJD order, so sorting them by any key that starts with `mjdExpStart`
+    sorts the whole stage.
+
+    Parameters
+    ----------
+    stage : `str`
+        Name of the stage.
+    columns : `list` or `None`
+        Columns to read, all by default. The night is the `mjd` column.
+    filter : `pyarrow.dataset.Expression` or `None`
+        Rows to keep, e.g. ``pyarrow.dataset.field("alt") > 0``.
+    sortBy : `str`, `list` or `None`
+        Columns to sort each night by.
+    mjds : `list` or `None`
+        Nights to scan, all by default.
+
+    Yields
+    ------
+    mjd : `int`
+        Night.
+    df : `pandas.DataFrame`
+        Selected rows and columns of the night.
+    """
+    dataset = openStage(stage, root)
+    nights = listNights(stage, root) if mjds is None else sorted(mjds)
+    for mjd in nights:
+        # the partition filter prunes every other night without reading it
+        expr = ds.field("mjd") == mjd
+        if filter is not None:
+            expr = expr & filter
+        df = dataset.to_table(columns=columns, filter=expr).to_pandas()
+        if sortBy is not None:
+            df = df.sort_values(sortBy, ignore_index=True, kind="stable")
+        yield mjd, df
+
+
+def writeCSV(stage, path, columns=None, filter=None, sortBy=None, mjds=None, root=DATA_DIR):
+    """Write nights of a stage to a single CSV, one night at a time.
+
+    Arguments are the same as for `scanStage`. Returns the number of rows.
+    """
+    nRows = 0
+    with open(path, "w") as f:
+        for i, (mjd, df) in enumerate(scanStage(stage, columns, filter, sortBy, mjds, root)):
+            df.to_csv(f, index=False, header=i == 0)
+            nRows += len(df)
+    return nRows
@@ -1,5 +1,39 @@
 import argparse
+import copy
 import json
+import os
+
+
+# datasets drawn one time step at a time and the names of their slices in a
+# time sliced spec, see slice_by_time
+TIME_SLICED_DATASETS = {"dataFields": "dataFieldsNow",
+                        "dataStars": "dataStarsNow",
+                        "dataMoon": "dataMoonNow"}
+
+# level of detail altitude tracks read by the altitude-time views, see lod_alts
+LOD_DATASET = "dataAlts"
+
+# base.json with its visual settings replaced by {"$param": name} and its
+# views named by their `description`, see render_spec
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "base_template.json")
+
+DEFAULT_PARAMS = {
+    "background": "#0e2836",
+    "skySize": 800,
+    "altsWidth": 630,
+    "altsHeight": 300,
+    # Scheduled Now, Available, Unavailable
+    "fieldColors": ["yellow", "blue", "#6E7DDB"],
+    "starSizes": [2, 50],
+}
+
+# parameters and excluded views of each variant, on top of the defaults
+VARIANTS = {
+    "default": {},
+    "compact": {"params": {"skySize": 560, "altsWidth": 440, "altsHeight": 210, "starSizes": [1, 30]}},
+    "colorblind": {"params": {"fieldColors": ["#F0E442", "#0072B2", "#999999"]}},
+    "plain": {"exclude": ["stars", "skyGraticule", "altLabels"]},
+}
 
 
 def guessDatasetContent(datasetEntry):
@@ -17,7 +51,7 @@ def guessDatasetContent(datasetEntry):
         return "AltAzLabels"
 
 
-def create_base_json(altairJson, baseJson, pretty_print=False, indent=4):
+def create_base_json(altairJson, baseJson, pretty_print=False, indent=4, time_sliced=False, lod=False):
     """Create a base.json file from a given Vega JSON file.
 
     A base JSON contains all the information required for vega-lite
@@ -30,6 +64,10 @@ def create_base_json(altairJson, baseJson, pretty_print=False, indent=4):
     Vega's default behaviour is to name and refer to individual datasts with
     a sha or a random set of strings. This will be replaced appropriately with
     above keys.
+
+    When `time_sliced` is set the time sliced variant of the spec is written,
+    see `slice_by_time`, and when `lod` is set the altitude-time views read the
+    level of detail altitude tracks, see `lod_alts`.
     """
     with open(altairJson, "r") as f:
         data = json.load(f)
@@ -48,22 +86,322 @@ def create_base_json(altairJson, baseJson, pretty_print=False, indent=4):
             base["datasets"][datasetContent] = []
             shaContentPairs[datasetSha] = datasetContent
 
-    # produce a string from our dict, replace the SHA for sensible column names
-    # and write the string to base.json
-    baseJsonStr = json.dumps(base)
-    for sha, name in shaContentPairs.items():
-        baseJsonStr = baseJsonStr.replace(sha, name)
-        base = json.loads(baseJsonStr)
+    # replace the SHA for sensible dataset names
+    base = bind_dataset_names(base, shaContentPairs)
 
-    with open(baseJson, "w") as f:
+    if lod:
+        base = lod_alts(base)
+    if time_sliced:
+        base = slice_by_time(base)
+
+    write_spec(base, baseJson, pretty_print, indent)
+
+
+def write_spec(spec, path, pretty_print=False, indent=4):
+    with open(path, "w") as f:
         if pretty_print:
-            json.dump(base, f, indent=indent)
+            json.dump(spec, f, indent=indent)
+        else:
+            json.dump(spec, f)
+
+
+def bind_dataset_names(spec, names):
+    """Rename datasets, and every reference to them, in one pass over the
+    spec. `names` maps the old names, e.g. SHAs, to the new ones."""
+    def walk(node):
+        if isinstance(node, list):
+            return [walk(child) for child in node]
+        if not isinstance(node, dict):
+            return node
+        bound = {}
+        for key, child in node.items():
+            if key == "datasets":
+                bound[key] = {names.get(name, name): values for name, values in child.items()}
+            elif key == "data" and isinstance(child, dict) and child.get("name") in names:
+                bound[key] = dict(child, name=names[child["name"]])
+            else:
+                bound[key] = walk(child)
+        return bound
+    return walk(spec)
+
+
+def load_template(path=TEMPLATE_FILE):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def render_spec(template, params=None, exclude=()):
+    """Spec made from a template, no Altair run needed.
+
+    Parameters
+    ----------
+    template : `dict`
+        Spec in which values are replaced by `{"$param": name}`, and views are
+        named by their `description`, see `load_template`.
+    params : `dict`
+        Values of the parameters, `DEFAULT_PARAMS` are used for the others.
+    exclude : `list`
+        Descriptions of the views, and layers, left out of the spec.
+
+    Raises
+    ------
+    KeyError
+        When the template uses a parameter that has no value.
+    ValueError
+        When an excluded view defined a selection the remaining views use.
+    """
+    values = dict(DEFAULT_PARAMS, **(params or {}))
+    exclude = set(exclude)
+
+    def render(node):
+        if isinstance(node, list):
+            return [render(child) for child in node
+                    if not (isinstance(child, dict) and child.get("description") in exclude)]
+        if not isinstance(node, dict):
+            return node
+        if set(node.keys()) == {"$param"}:
+            return copy.deepcopy(values[node["$param"]])
+        return {key: render(child) for key, child in node.items()}
+
+    spec = render(template)
+    check_selections(spec)
+    return spec
+
+
+def check_selections(spec):
+    """Raise a `ValueError` if the spec uses selections it does not define."""
+    defined, used = set(), set()
+
+    def walk(node):
+        if isinstance(node, list):
+            for child in node:
+                walk(child)
+        elif isinstance(node, dict):
+            selections = node.get("selection")
+            # definitions map names to selections, references are names or
+            # logical compositions of names
+            if isinstance(selections, dict) and all(isinstance(sel, dict) and "type" in sel
+                                                    for sel in selections.values()):
+                defined.update(selections.keys())
+            elif selections is not None:
+                used.add(json.dumps(selections))
+            for key, child in node.items():
+                if key not in ("datasets", "selection"):
+                    walk(child)
+
+    walk(spec)
+
+    def names(ref):
+        if isinstance(ref, str):
+            return {ref}
+        if isinstance(ref, dict):
+            return set().union(*(names(child) for child in ref.values()))
+        if isinstance(ref, list):
+            return set().union(*(names(child) for child in ref))
+        return set()
+
+    missing = set().union(set(), *(names(json.loads(ref)) for ref in used)) - defined
+    if missing:
+        raise ValueError("Selections %s are used but no longer defined."%", ".join(sorted(missing)))
+
+
+def build_variants(variants, outPath, template=None, params=None, exclude=(), time_sliced=False, lod=False,
+                   pretty_print=False, indent=4):
+    """Write a spec per variant, see `VARIANTS`. The default variant is written
+    to `outPath`, the others next to it as `<name>-<variant>.json`.
+
+    Returns
+    -------
+    paths : `list`
+        Paths of the written specs.
+    """
+    template = load_template() if template is None else template
+    stem, ext = os.path.splitext(outPath)
+    paths = []
+    for variant in variants:
+        settings = VARIANTS[variant]
+        variantParams = dict(settings.get("params", {}), **(params or {}))
+        spec = render_spec(template, variantParams, list(settings.get("exclude", [])) + list(exclude))
+        if lod:
+            spec = lod_alts(spec)
+        if time_sliced:
+            spec = slice_by_time(spec)
+        path = outPath if variant == "default" else "%s-%s%s"%(stem, variant, ext)
+        write_spec(spec, path, pretty_print, indent)
+        paths.append(path)
+    return paths
+
+
+def find_selection(spec, field):
+    """Name of the first selection made on the given field, e.g. the time
+    step (tsid) or the field ID (fid), `None` if there is none."""
+    def walk(node):
+        if isinstance(node, dict):
+            selections = node.get("selection")
+            if isinstance(selections, dict):
+                for name, selection in selections.items():
+                    if isinstance(selection, dict) and selection.get("fields") == [field]:
+                        return name
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
+        else:
+            return None
+        for child in children:
+            found = walk(child)
+            if found is not None:
+                return found
+        return None
+    return walk(spec)
+
+
+def slice_by_time(base, time_field="tsid"):
+    """Variant of a base spec in which layers showing one time step read it
+    from a dataset holding only that time step's rows.
+
+    Every view that filters one of the `TIME_SLICED_DATASETS` by the time
+    selection reads the dataset's slice instead, without the filter. The page
+    swaps the rows of the selected time step into the slices, from the rows
+    the exporter ordered by time step (see convert_csv_json.sliceByTime), so
+    hovering no longer filters every row of the night once per layer. Views
+    that show all time steps, e.g. the altitude tracks, are not changed.
+
+    The selection and the slices are listed under `usermeta.timeSlices`.
+    """
+    spec = copy.deepcopy(base)
+    selection = find_selection(spec, time_field)
+    if selection is None:
+        raise ValueError("No selection on %s in the spec."%time_field)
+    timeFilter = {"filter": {"selection": selection}}
+
+    def walk(node, dataName):
+        if isinstance(node, list):
+            for child in node:
+                walk(child, dataName)
+            return
+        if not isinstance(node, dict):
+            return
+        data = node.get("data")
+        if isinstance(data, dict) and "name" in data:
+            dataName = data["name"]
+        transforms = node.get("transform", [])
+        if dataName in TIME_SLICED_DATASETS and timeFilter in transforms:
+            node["transform"] = [t for t in transforms if t != timeFilter]
+            if not node["transform"]:
+                del node["transform"]
+            node["data"] = {"name": TIME_SLICED_DATASETS[dataName]}
+        for key, child in node.items():
+            if key not in ("data", "transform", "datasets"):
+                walk(child, dataName)
+
+    walk(spec, None)
+    for name, sliceName in TIME_SLICED_DATASETS.items():
+        if name in spec["datasets"]:
+            spec["datasets"][sliceName] = []
+
+    init = find_selection_init(spec, selection, time_field)
+    spec.setdefault("usermeta", {})["timeSlices"] = {
+        "selection": selection,
+        "field": time_field,
+        "init": init,
+        "datasets": {name: sliceName for name, sliceName in TIME_SLICED_DATASETS.items() if name in spec["datasets"]},
+    }
+    return spec
+
+
+def lod_alts(base):
+    """Variant of a base spec whose altitude-time views read the level of
+    detail altitude tracks (see altairPlotting.get_alt_tracks) instead of
+    every row of the night.
+
+    Views plotting `alt` against `st` for the whole night read
+    `LOD_DATASET`. Views of the selected time step keep their data. Under
+    them a rule is drawn from the lowest to the highest altitude of every
+    binned row of the selected fields, so the binning hides no altitudes.
+    """
+    spec = copy.deepcopy(base)
+    timeSelection = find_selection(spec, "tsid")
+    fieldSelection = find_selection(spec, "fid")
+    if fieldSelection is None:
+        raise ValueError("No selection on fid in the spec.")
+    timeFilter = {"filter": {"selection": timeSelection}}
+
+    def isAltView(node):
+        encoding = node.get("encoding", {})
+        return (encoding.get("x", {}).get("field") == "st"
+                and encoding.get("y", {}).get("field") == "alt"
+                and timeFilter not in node.get("transform", []))
+
+    # (layer list, view) of every changed view
+    changed = []
+
+    def walk(node, dataName, layer):
+        if isinstance(node, list):
+            for child in node:
+                walk(child, dataName, layer)
+            return
+        if not isinstance(node, dict):
+            return
+        data = node.get("data")
+        if isinstance(data, dict) and "name" in data:
+            dataName = data["name"]
+        if "mark" in node and dataName == "dataFields" and isAltView(node):
+            node["data"] = {"name": LOD_DATASET}
+            changed.append((layer, node))
+        for key, child in node.items():
+            if key not in ("data", "transform", "datasets"):
+                walk(child, dataName, node["layer"] if key == "layer" else layer)
+
+    walk(spec, None, None)
+    if not changed:
+        raise ValueError("No altitude-time views in the spec.")
+
+    layer, view = changed[0]
+    envelope = {
+        "description": "altsEnvelope",
+        "data": {"name": LOD_DATASET},
+        "mark": {"type": "rule", "opacity": 0.5, "strokeWidth": 3},
+        "encoding": {
+            "x": {"field": "st", "type": "temporal"},
+            "y": {"field": "altMin", "type": "quantitative"},
+            "y2": {"field": "altMax"},
+        },
+        "transform": [{"filter": {"selection": fieldSelection}}, {"filter": "datum.n > 1"}],
+    }
+    if "color" in view["encoding"]:
+        envelope["encoding"]["color"] = copy.deepcopy(view["encoding"]["color"])
+    if layer is not None:
+        layer.insert(layer.index(view), envelope)
+
+    spec["datasets"][LOD_DATASET] = []
+    return spec
+
+
+def find_selection_init(spec, selection, field):
+    """Initial value of a field of a selection, `None` if it has none."""
+    def walk(node):
+        if isinstance(node, dict):
+            selections = node.get("selection")
+            if isinstance(selections, dict) and isinstance(selections.get(selection), dict):
+                init = selections[selection].get("init")
+                if isinstance(init, dict) and field in init:
+                    return init[field]
+            children = node.values()
+        elif isinstance(node, list):
+            children = node
         else:
-            json.dump(base, f)
+            return None
+        for child in children:
+            found = walk(child)
+            if found is not None:
+                return found
+        return None
+    return walk(spec)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generate a base.json from a Vega JSON file.")
+    parser = argparse.ArgumentParser(description="Generate a base.json from a Vega JSON file, or from the "
+                                     "spec template.")
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument("input", type=str, action="store", nargs="?")
@@ -75,7 +413,31 @@ if __name__ == "__main__":
                         help="Produce a human readable base.json")
     parser.add_argument("--indent", type=int, default=4,
                         help="N. spaces in indentation. Must use --pretty-print.")
+    parser.add_argument("-t", "--time-sliced", action="store_true",
+                        help="Read the views of the current time step from per time step slices, "
+                        "see convert_csv_json.py --time-sliced.")
+    parser.add_argument("-l", "--lod", action="store_true",
+                        help="Draw the altitude-time plot from binned altitude tracks, "
+                        "see convert_csv_json.py --alt-bin.")
+    parser.add_argument("--template", nargs="?", const=TEMPLATE_FILE, default=None,
+                        help="Render the spec from a template instead of a Vega JSON file, %s by default."
+                        %os.path.basename(TEMPLATE_FILE))
+    parser.add_argument("--variant", nargs="+", default=["default"], choices=sorted(VARIANTS),
+                        help="Variants rendered from the template.")
+    parser.add_argument("--set", nargs="+", default=[], metavar="NAME=JSON",
+                        help="Template parameters, e.g. skySize=600 'fieldColors=[\"red\",\"green\",\"grey\"]'.")
+    parser.add_argument("--exclude", nargs="+", default=[],
+                        help="Descriptions of the template views to leave out, e.g. stars.")
 
     args = parser.parse_args()
-    vegaJson = args.input_json if args.input is None else args.input
-    create_base_json(vegaJson, args.output_json, args.pretty_print, args.indent)
+    if args.template is not None:
+        params = {}
+        for setting in args.set:
+            name, value = setting.split("=", 1)
+            params[name] = json.loads(value)
+        paths = build_variants(args.variant, args.output_json, load_template(args.template), params, args.exclude,
+                               args.time_sliced, args.lod, args.pretty_print, args.indent)
+        print("wrote", ", ".join(paths))
+    else:
+        vegaJson = args.input_json if args.input is None else args.input
+        create_base_json(vegaJson, args.output_json, args.pretty_print, args.indent, args.time_sliced, args.lod)